@@ -0,0 +1,25 @@
+# Copyright (C) 2011-2018 Eric Leblond <eric@regit.org>
+#
+# You can copy, redistribute or modify this Program under the terms of
+# the GNU General Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# version 3 along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Benchmarks of coccigrep
+
+ - corpus: generator of synthetic C trees
+ - fake_spatch: spatch stand-in with controllable latency
+ - run: harness timing each phase of a search
+
+Run `python -m bench.run -h` from the source directory for usage.
+"""
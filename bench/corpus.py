@@ -0,0 +1,147 @@
+# Copyright (C) 2011-2018 Eric Leblond <eric@regit.org>
+#
+# You can copy, redistribute or modify this Program under the terms of
+# the GNU General Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# version 3 along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Generator of deterministic synthetic C trees
+
+The generated tree contains headers defining structures (each header
+including the previous one up to a given depth) and C files spread in
+directories with functions dereferencing, setting and testing attributes
+of the structures and calling functions with them.
+"""
+
+import argparse
+import random
+from os import makedirs, path
+
+
+STRUCT_PREFIX = "bstruct"
+ATTRIBUTES = ["count", "flags", "len", "next", "priv", "state", "data", "id"]
+
+
+def struct_name(index):
+    return "%s%d" % (STRUCT_PREFIX, index)
+
+
+def _write(fname, content):
+    dirname = path.dirname(fname)
+    if not path.isdir(dirname):
+        makedirs(dirname)
+    with open(fname, 'w') as f:
+        f.write(content)
+
+
+def _header(index, include_depth):
+    content = "#ifndef BENCH_H%d\n#define BENCH_H%d\n\n" % (index, index)
+    if include_depth > 0 and index % include_depth != 0:
+        content += '#include "h%d.h"\n\n' % (index - 1)
+    content += "struct %s {\n" % struct_name(index)
+    for attribute in ATTRIBUTES:
+        content += "\tint %s;\n" % attribute
+    content += "};\n\n"
+    content += "void %s_use(struct %s *p);\n\n#endif\n" % (struct_name(index),
+        struct_name(index))
+    return content
+
+
+def _function(rand, name, nstructs, accesses):
+    sindex = rand.randrange(nstructs)
+    sname = struct_name(sindex)
+    content = "int %s(struct %s *p, struct %s s)\n{\n\tint ret = 0;\n" % (
+        name, sname, sname)
+    for i in range(accesses):
+        attribute = rand.choice(ATTRIBUTES)
+        kind = rand.randrange(5)
+        if kind == 0:
+            content += "\tp->%s = %d;\n" % (attribute, i)
+        elif kind == 1:
+            content += "\tret += p->%s;\n" % attribute
+        elif kind == 2:
+            content += "\tif (s.%s == %d)\n\t\tret++;\n" % (attribute, i)
+        elif kind == 3:
+            content += "\t%s_use(p);\n" % sname
+        else:
+            content += "\t/* nothing to see here */\n\tret = ret * 2;\n"
+    content += "\treturn ret;\n}\n\n"
+    return (sindex, content)
+
+
+def generate(directory, nfiles=100, nstructs=10, functions=5, accesses=10,
+             include_depth=3, files_per_dir=50, seed=0):
+    """
+    Generate a synthetic C tree
+
+    :param directory: directory where the tree is written
+    :type directory: str
+    :param nfiles: number of C files
+    :type nfiles: int
+    :param nstructs: number of structures (and headers)
+    :type nstructs: int
+    :param functions: number of functions per C file
+    :type functions: int
+    :param accesses: number of statements per function
+    :type accesses: int
+    :param include_depth: length of chains of headers including each other
+    :type include_depth: int
+    :param files_per_dir: number of C files per directory
+    :type files_per_dir: int
+    :param seed: seed of the random generator
+    :type seed: int
+    :return: dict describing the generated tree
+    """
+    rand = random.Random(seed)
+    total_size = 0
+    for index in range(nstructs):
+        content = _header(index, include_depth)
+        total_size += len(content)
+        _write(path.join(directory, "include", "h%d.h" % index), content)
+    for findex in range(nfiles):
+        used = set()
+        body = ""
+        for function in range(functions):
+            (sindex, content) = _function(rand, "func_%d_%d" % (findex,
+                function), nstructs, accesses)
+            used.add(sindex)
+            body += content
+        includes = "".join('#include "../include/h%d.h"\n' % sindex
+            for sindex in sorted(used))
+        content = includes + "\n" + body
+        total_size += len(content)
+        _write(path.join(directory, "dir%d" % (findex // files_per_dir),
+            "file%d.c" % findex), content)
+    return {'files': nfiles, 'structs': nstructs, 'functions': functions,
+            'accesses': accesses, 'include_depth': include_depth,
+            'seed': seed, 'size': total_size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic C tree')
+    parser.add_argument('directory', help='Output directory')
+    parser.add_argument('-n', '--files', type=int, default=100, help='Number of C files')
+    parser.add_argument('-s', '--structs', type=int, default=10, help='Number of structures')
+    parser.add_argument('-f', '--functions', type=int, default=5, help='Number of functions per file')
+    parser.add_argument('-a', '--accesses', type=int, default=10, help='Number of statements per function')
+    parser.add_argument('-i', '--include-depth', type=int, default=3, help='Depth of header include chains')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+    args = parser.parse_args()
+    info = generate(args.directory, nfiles=args.files, nstructs=args.structs,
+        functions=args.functions, accesses=args.accesses,
+        include_depth=args.include_depth, seed=args.seed)
+    print("Generated %(files)d files (%(size)d bytes)" % info)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2018 Eric Leblond <eric@regit.org>
+#
+# You can copy, redistribute or modify this Program under the terms of
+# the GNU General Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# version 3 along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+spatch stand-in used to benchmark coccigrep without coccinelle
+
+It accepts the command line used by coccigrep and outputs matches in the
+format of the coccigrep python script: every dereference of the attribute
+found in the semantic patch (or of any attribute if there is none) is
+reported. Latency is controlled by environment variables:
+
+ - FAKE_SPATCH_STARTUP: seconds spent before handling files
+ - FAKE_SPATCH_LATENCY: seconds spent per file
+ - FAKE_SPATCH_BYTE_LATENCY: seconds spent per byte of file
+"""
+
+import os
+import re
+import sys
+import time
+
+VERSION = "1.1.1"
+# options followed by a value
+VALUE_OPTIONS = ('-sp_file', '-I', '--undefined', '--defined')
+
+
+def parse_args(argv):
+    sp_file = None
+    files = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in VALUE_OPTIONS:
+            if arg == '-sp_file':
+                sp_file = argv[i + 1]
+            i += 2
+            continue
+        if not arg.startswith('-'):
+            files.append(arg)
+        i += 1
+    return (sp_file, files)
+
+
+def main():
+    if '-version' in sys.argv:
+        print("spatch version %s with Python support and with PCRE support"
+            % VERSION)
+        return 0
+    (sp_file, files) = parse_args(sys.argv[1:])
+    with open(sp_file) as f:
+        patch = f.read()
+    tags = re.findall(r'print\("(q\d+):', patch) or [None]
+    attributes = set(re.findall(r'->(\w+)', patch))
+    deref = re.compile(r'(\w+)(->|\.)(\w+)')
+    time.sleep(float(os.environ.get('FAKE_SPATCH_STARTUP', '0')))
+    latency = float(os.environ.get('FAKE_SPATCH_LATENCY', '0'))
+    byte_latency = float(os.environ.get('FAKE_SPATCH_BYTE_LATENCY', '0'))
+    for fname in files:
+        sys.stderr.write("HANDLING: %s\n" % fname)
+        try:
+            with open(fname) as f:
+                lines = f.readlines()
+        except IOError:
+            continue
+        time.sleep(latency + byte_latency * sum(len(line) for line in lines))
+        for (index, line) in enumerate(lines):
+            for match in deref.finditer(line):
+                if attributes and match.group(3) not in attributes:
+                    continue
+                position = "%s:%d:%d:%d:%d" % (fname, index + 1,
+                    match.start(1), index + 1, match.end(1))
+                for tag in tags:
+                    if tag:
+                        sys.stdout.write("%s:%s\n" % (tag, position))
+                    else:
+                        sys.stdout.write(position + "\n")
+        sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
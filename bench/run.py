@@ -0,0 +1,200 @@
+# Copyright (C) 2011-2018 Eric Leblond <eric@regit.org>
+#
+# You can copy, redistribute or modify this Program under the terms of
+# the GNU General Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# version 3 along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Benchmark harness of coccigrep
+
+A synthetic tree is generated (see :mod:`bench.corpus`) and a search is run
+on it with the fake spatch (see :mod:`bench.fake_spatch`) unless a real one
+is asked. The time spent in each phase of the search is measured:
+
+ - discovery: walk of the tree
+ - render: build of the semantic patch
+ - spatch: spawn of spatch and read of its output
+ - parse: build of matches from the output
+ - display_MODE: display of all matches in each mode
+ - search_pN: complete search with N processes
+
+Results are written as JSON so runs can be compared with --compare.
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from os import environ, path
+
+from bench import corpus
+
+HERE = path.dirname(path.abspath(__file__))
+FAKE_SPATCH = path.join(HERE, 'fake_spatch.py')
+DISPLAY_MODES = ['raw', 'grep', 'vim', 'emacs', 'color', 'json']
+
+
+def load_coccigrep():
+    """
+    Import coccigrep from the source tree, or the installed one if the
+    harness is not run from a source tree
+    """
+    source = path.join(path.dirname(HERE), 'src', '__init__.py')
+    if not path.isfile(source):
+        import coccigrep
+        return coccigrep
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('coccigrep', source,
+        submodule_search_locations=[path.dirname(source)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['coccigrep'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(function, repeat=1):
+    """
+    :return: (result of last call, best time of the calls in seconds)
+    """
+    best = None
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (result, best)
+
+
+def new_search(coccigrep, args):
+    search = coccigrep.CocciGrep()
+    search.set_spatch_cmd(args.spatch)
+    search.set_use_git(False)
+    search.setup(args.type, args.attribute, args.operation)
+    return search
+
+
+def run(args):
+    coccigrep = load_coccigrep()
+    results = {'coccigrep': coccigrep.COCCIGREP_VERSION,
+               'python': platform.python_version(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'spatch': args.spatch,
+               'latency': {'startup': args.startup, 'file': args.latency},
+               'phases': {}}
+    phases = results['phases']
+    environ['FAKE_SPATCH_STARTUP'] = str(args.startup)
+    environ['FAKE_SPATCH_LATENCY'] = str(args.latency)
+
+    directory = args.corpus
+    cleanup = False
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='coccigrep-bench-')
+        cleanup = True
+    try:
+        results['corpus'] = corpus.generate(directory, nfiles=args.files,
+            nstructs=args.structs, include_depth=args.include_depth,
+            seed=args.seed)
+
+        search = new_search(coccigrep, args)
+        (files, phases['discovery']) = timed(
+            lambda: search.find_files([directory]), args.repeat)
+        (cocci_grep, phases['render']) = timed(search._render_cocci,
+            args.repeat)
+
+        # run spatch once on all files keeping the raw output
+        sp_file = tempfile.NamedTemporaryFile(suffix='.cocci', mode='w')
+        sp_file.write(cocci_grep)
+        sp_file.flush()
+        cmd = [args.spatch] + search.options + ['-sp_file', sp_file.name]
+        cmd += files
+        (lines, phases['spatch']) = timed(
+            lambda: list(coccigrep.coccigrep._spatch_lines(cmd, False)))
+        sp_file.close()
+        (matches, phases['parse']) = timed(
+            lambda: list(search._parse_output(lines)), args.repeat)
+        results['matches'] = len(matches)
+
+        for mode in DISPLAY_MODES:
+            if mode == 'color' and not coccigrep.coccigrep._import_pygments():
+                continue
+
+            def display():
+                search.line_cache.clear()
+                return ''.join(search.iter_display(matches, mode=mode,
+                    before=args.context, after=args.context))
+            (output, phases['display_' + mode]) = timed(display, args.repeat)
+
+        for ncpus in args.ncpus:
+            search = new_search(coccigrep, args)
+            search.set_concurrency(ncpus)
+            (found, phases['search_p%d' % ncpus]) = timed(
+                lambda: list(search.iter_matches(files)))
+    finally:
+        if cleanup:
+            shutil.rmtree(directory)
+    return results
+
+
+def compare(old, new):
+    print("%-20s %12s %12s %8s" % ("phase", "old (s)", "new (s)", "ratio"))
+    for phase in sorted(set(old['phases']) | set(new['phases'])):
+        old_time = old['phases'].get(phase)
+        new_time = new['phases'].get(phase)
+        if old_time is None or new_time is None:
+            print("%-20s %12s %12s" % (phase, old_time, new_time))
+            continue
+        ratio = new_time / old_time if old_time else float('inf')
+        print("%-20s %12.4f %12.4f %8.2f" % (phase, old_time, new_time, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark coccigrep')
+    parser.add_argument('-n', '--files', type=int, default=200, help='Number of C files of the corpus')
+    parser.add_argument('-s', '--structs', type=int, default=10, help='Number of structures of the corpus')
+    parser.add_argument('-i', '--include-depth', type=int, default=3, help='Depth of header include chains')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus generator')
+    parser.add_argument('--corpus', default=None, help='Directory where corpus is generated (temporary by default)')
+    parser.add_argument('--spatch', default=FAKE_SPATCH, help='spatch command (fake spatch by default)')
+    parser.add_argument('--startup', type=float, default=0.05, help='Startup time of fake spatch in seconds')
+    parser.add_argument('--latency', type=float, default=0.001, help='Time per file of fake spatch in seconds')
+    parser.add_argument('-t', '--type', default='struct %s' % corpus.struct_name(0), help='Searched type')
+    parser.add_argument('-a', '--attribute', default='count', help='Searched attribute')
+    parser.add_argument('-o', '--operation', default='deref', help='Searched operation')
+    parser.add_argument('-C', '--context', type=int, default=0, help='Lines of context in display')
+    parser.add_argument('-p', '--ncpus', type=int, action='append', default=None, help='Concurrency level of complete search (can be repeated)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs of fast phases')
+    parser.add_argument('-w', '--output', default=None, help='JSON file where results are written')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+    if args.ncpus is None:
+        args.ncpus = [1, 4]
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    elif not args.output:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
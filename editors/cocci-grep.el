@@ -43,6 +43,9 @@
 (defvar cocci-s-operation-history '()
   "The minibuffer history list for `\\[cocci-grep]'s operation argument.")
 
+(defvar cocci-grep-server nil
+  "If non-nil, path of the socket of a `coccigrep --server' to send requests to.")
+
 (defvar cocci-files-history '()
   "The minibuffer history list for `\\[cocci-grep]'s files argument.")
 
@@ -79,7 +82,11 @@ operation on structure and files is a blob expression that will match files"
                 (cocci-grep-read-file-string)))
   (let (out-buf
         )
-    (setq out-buf (compilation-start (concat "coccigrep -E -t " s-type " -a " s-attribute
+    (setq out-buf (compilation-start (concat "coccigrep -E "
+                                             (if cocci-grep-server
+                                                 (concat "--connect " cocci-grep-server " ")
+                                               "")
+                                             "-t " s-type " -a " s-attribute
                                              " -o " s-operation " " files) 'grep-mode))
     ))
 
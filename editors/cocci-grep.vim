@@ -94,6 +94,10 @@ function! s:CocciGrep(...)
         let cgrep = cgrep . ' -l ' . g:coccigrep_files
     endif
 
+    if exists("g:coccigrep_server")
+        let cgrep = '--connect ' . g:coccigrep_server . ' ' . cgrep
+    endif
+
     echo "Running coccigrep, please wait..."
     let cocciout = system(g:coccigrep_path . ' '. cgrep)
     if cocciout == ""
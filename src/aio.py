@@ -0,0 +1,310 @@
+# Copyright (C) 2011-2018 Eric Leblond <eric@regit.org>
+#
+# You can copy, redistribute or modify this Program under the terms of
+# the GNU General Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# version 3 along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+asyncio interface of coccigrep (python 3.6 and later)
+
+Searches are run with asyncio subprocesses so a single process can
+serve many concurrent searches with the same :class:`CocciGrep`::
+
+    grep = CocciGrep()
+    async with grep.search(CocciQuery('deref', 'struct foo'), files) as matches:
+        async for match in matches:
+            print(match.display('struct foo'))
+
+A search only reads the configuration of the :class:`CocciGrep` (spatch
+command, options, batch size, sharding, timeout and maximum number of
+matches): it does not use its setup and does not store anything in it
+but the version of spatch and the semantic patches of the operations.
+These are resolved once per search, in an executor thread holding a
+lock shared by all the searches, so searches run from several threads
+or event loops don't race on them. The matches of a search read the
+source lines from a cache of their own instead of the line cache of the
+:class:`CocciGrep`. The number of spatch processes
+running at the same time is limited by :data:`max_children` for all the
+searches of an event loop. Cancelling a search, or leaving the
+``async with`` block of its matches, kills its spatch processes.
+Leaving only the ``async for`` loop (with ``break``) does not: the
+processes are killed when the search is garbage collected. Without
+``async with``, call ``await matches.aclose()`` to stop a search early.
+"""
+
+import asyncio
+import threading
+import weakref
+from os import cpu_count, stat, unlink
+from sys import stderr
+
+from .coccigrep import CocciIncludeGraph, CocciLineCache, CocciPatchCache, \
+    CocciQuery, CocciRunException, _default_cache_dir, _include_options, \
+    _make_batches, _make_include_batches, _output_key, _parse_match, \
+    _raise_run_err
+
+# maximum number of spatch processes of all searches of an event loop
+max_children = cpu_count() or 1
+_limits = weakref.WeakKeyDictionary()
+# protects the version of spatch and the templates cached in CocciGrep
+_setup_lock = threading.Lock()
+
+
+def set_max_children(count):
+    """
+    Set the number of spatch processes run at the same time
+
+    It must be called before the first search of the event loop.
+
+    :param count: maximum number of spatch processes
+    :type count: int
+    """
+    global max_children
+    max_children = max(1, count)
+    _limits.clear()
+
+
+def _limit():
+    loop = asyncio.get_event_loop()
+    semaphore = _limits.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max_children)
+        _limits[loop] = semaphore
+    return semaphore
+
+
+class _Display(object):
+    """
+    Display state of the matches of a search
+    """
+    attribute = None
+
+    def __init__(self, grep):
+        self.line_cache = CocciLineCache(grep.line_cache.max_size)
+
+
+def _prepare(grep, queries, files):
+    """
+    Get the semantic patch and the batches of files of a search
+
+    It is blocking so it is run in an executor.
+
+    :return: (name of the semantic patch, True if it is a temporary file,
+              list of (files, headers))
+    """
+    with _setup_lock:
+        patch_key = grep._patch_key(queries)
+        cocci_grep = grep._render_cocci(queries)
+    patches = CocciPatchCache(grep.cache_dir or _default_cache_dir())
+    sp_file = patches.lookup(patch_key)
+    temporary = False
+    if sp_file is None:
+        sp_file = patches.store(patch_key, cocci_grep)
+        if sp_file is None:
+            # store is not writable, use a temporary file
+            from tempfile import NamedTemporaryFile
+            with NamedTemporaryFile(suffix=".cocci", mode='w',
+                                    delete=False) as tmp_cocci_file:
+                tmp_cocci_file.write(cocci_grep)
+            sp_file = tmp_cocci_file.name
+            temporary = True
+    batch_size = grep.batch_size
+    if batch_size <= 0:
+        total_size = 0
+        for fname in files:
+            try:
+                total_size += stat(fname).st_size
+            except OSError:
+                pass
+        batch_size = max(1, total_size // (max_children * 4))
+    if grep.sharding == 'include':
+        graph = CocciIncludeGraph(grep._include_dirs(), max(4, max_children))
+        shards = _make_include_batches(files, batch_size, graph)
+    else:
+        shards = [(sub_files, ())
+                  for sub_files in _make_batches(files, batch_size)]
+    return (sp_file, temporary, shards)
+
+
+async def _spatch(cmd, verbose, timeout):
+    """
+    Run spatch once a slot is available
+
+    :return: (list of output lines, None or the reason of the failure)
+    """
+    async with _limit():
+        if verbose:
+            stderr.write("Running: %s.\n" % " ".join(cmd))
+        try:
+            process = await asyncio.create_subprocess_exec(*cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=None if verbose else asyncio.subprocess.DEVNULL)
+        except OSError as err:
+            _raise_run_err(err, cmd)
+        lines = []
+
+        async def read():
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                lines.append(line)
+            await process.wait()
+
+        try:
+            await asyncio.wait_for(read(), timeout or None)
+        except asyncio.TimeoutError:
+            return (lines, "timeout after %d seconds" % timeout)
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+    if process.returncode < 0:
+        return (lines, "killed by signal %d" % -process.returncode)
+    return (lines, None)
+
+
+async def _search_shard(grep, cmd, files, headers):
+    """
+    Run spatch on a batch of files
+
+    A batch on which spatch is killed is split in two batches until the
+    guilty file is found, it is then skipped.
+
+    :return: list of output lines
+    """
+    pending = [files]
+    lines = []
+    while len(pending):
+        sub_files = pending.pop(0)
+        (output, failure) = await _spatch(cmd + sub_files +
+            _include_options(sub_files, headers), grep.verbose, grep.timeout)
+        if failure is None:
+            lines += output
+        elif len(sub_files) > 1:
+            middle = len(sub_files) // 2
+            pending = [sub_files[:middle], sub_files[middle:]] + pending
+        else:
+            stderr.write("Warning: spatch failed on '%s' (%s), skipping it.\n"
+                % (sub_files[0], failure))
+    return lines
+
+
+class CocciSearch(object):
+    """
+    Matches of a running search
+
+    It is an async iterator of :class:`CocciMatch` and an async context
+    manager which stops the search (cancelling its batches and killing
+    its spatch processes) when leaving its block.
+    """
+    def __init__(self, matches):
+        self.matches = matches
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.matches.__anext__()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Stop the search
+        """
+        await self.matches.aclose()
+
+
+def search(grep, query, files):
+    """
+    Search asynchronously
+
+    Files are split in batches run in parallel. Matches of a batch are
+    sorted and yielded in the order of the batches. Matches in headers
+    which are not searched are yielded at the end.
+
+    :param grep: search configuration
+    :type grep: :class:`CocciGrep`
+    :param query: query or list of queries searched in a single run
+    :type query: :class:`CocciQuery` or list of :class:`CocciQuery`
+    :param files: list of filenames
+    :type files: list of str
+    :return: a :class:`CocciSearch`
+    :raise: :class:`CocciRunException` or :class:`CocciConfigException`
+            when iterating
+    """
+    return CocciSearch(_search(grep, query, files))
+
+
+async def _search(grep, query, files):
+    if isinstance(query, CocciQuery):
+        queries = [query]
+    else:
+        queries = list(query)
+    if len(queries) == 0:
+        raise CocciRunException("No query to search")
+    files = list(files)
+    if len(files) == 0:
+        raise CocciRunException("Can't use coccigrep without files "
+            "to search")
+    loop = asyncio.get_event_loop()
+    (sp_file, temporary, shards) = await loop.run_in_executor(None,
+        _prepare, grep, queries, files)
+    cmd = [grep.spatch] + grep.options + ["-sp_file", sp_file]
+    owner = {}
+    for (index, (sub_files, sub_headers)) in enumerate(shards):
+        for fname in sub_files:
+            owner[fname] = index
+    tasks = [asyncio.ensure_future(_search_shard(grep, cmd, sub_files,
+                 sub_headers)) for (sub_files, sub_headers) in shards]
+    display = _Display(grep)
+    foreign = {}
+    count = 0
+    try:
+        for (index, task) in enumerate(tasks):
+            output = []
+            for line in await task:
+                key = _output_key(line, True)
+                if key is None:
+                    continue
+                fowner = owner.get(key[0])
+                if fowner is None:
+                    foreign[key] = line
+                elif fowner == index:
+                    output.append((key, line))
+            output.sort()
+            last_key = None
+            for (key, line) in output:
+                if key != last_key:
+                    yield _parse_match(line, display, queries)
+                    count += 1
+                    if count == grep.max_count:
+                        return
+                last_key = key
+        for key in sorted(foreign):
+            yield _parse_match(foreign[key], display, queries)
+            count += 1
+            if count == grep.max_count:
+                return
+    finally:
+        for task in tasks:
+            task.cancel()
+        # wait for the spatch processes to be killed
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if temporary:
+            unlink(sp_file)
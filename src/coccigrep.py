@@ -18,32 +18,120 @@ try:
     from configparser import ConfigParser as PyConfigParser
 except Exception:
     from ConfigParser import SafeConfigParser as PyConfigParser
-from os import unlink, path, listdir, getcwd
+from array import array
+from collections import OrderedDict, deque
+from os import path, listdir, getcwd, makedirs, rename, stat, environ, devnull, \
+    access, pathsep, walk, chdir, unlink, utime, X_OK
 from string import Template
 from subprocess import Popen, PIPE, STDOUT
 from sys import stderr, stdout
-from tempfile import NamedTemporaryFile
+from threading import Thread, Timer
+from time import time
 import errno
+import fnmatch
+import heapq
+import mmap
+import os
 import re
+import select
 import sys
 
 COCCIGREP_VERSION = "1.21"
 
-have_multiprocessing = True
+# Heavy and optional modules are imported by the code paths using them so
+# that startup stays fast: each _import_* function imports its modules on
+# first call and tells if they are available.
+have_multiprocessing = None
+Pool = None
+
+
+def _import_multiprocessing():
+    global have_multiprocessing, Pool
+    if have_multiprocessing is None:
+        try:
+            from multiprocessing import Pool
+            have_multiprocessing = True
+        except ImportError:
+            have_multiprocessing = False
+    return have_multiprocessing
+
+
+have_selectors = None
+selectors = None
+
+
+def _import_selectors():
+    global have_selectors, selectors
+    if have_selectors is None:
+        try:
+            import selectors
+            have_selectors = True
+        except ImportError:
+            have_selectors = False
+    return have_selectors
+
+
+have_futures = None
+ThreadPoolExecutor = None
+
+
+def _import_futures():
+    global have_futures, ThreadPoolExecutor
+    if have_futures is None:
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+            have_futures = True
+        except ImportError:
+            have_futures = False
+    return have_futures
+
+
+have_sqlite = None
+sqlite3 = None
+
+
+def _import_sqlite():
+    global have_sqlite, sqlite3
+    if have_sqlite is None:
+        try:
+            import sqlite3
+            have_sqlite = True
+        except ImportError:
+            have_sqlite = False
+    return have_sqlite
+
+
+have_pygments = None
+format_tokens = CLexer = NameHighlightFilter = None
+Terminal256Formatter = HtmlFormatter = None
+
+
+def _import_pygments():
+    global have_pygments, format_tokens, CLexer, NameHighlightFilter
+    global Terminal256Formatter, HtmlFormatter
+    if have_pygments is None:
+        try:
+            from pygments import format as format_tokens
+            from pygments.lexers import CLexer
+            from pygments.filters import NameHighlightFilter
+            from pygments.formatters import Terminal256Formatter, HtmlFormatter
+            have_pygments = True
+        except ImportError:
+            have_pygments = False
+    return have_pygments
+
+
 try:
-    from multiprocessing import Process, Pipe
+    from os import scandir
 except ImportError:
-    have_multiprocessing = False
+    scandir = None
 
 
-have_pygments = True
+have_resource = True
 try:
-    from pygments import highlight
-    from pygments.lexers import CLexer
-    from pygments.filters import NameHighlightFilter
-    from pygments.formatters import Terminal256Formatter, HtmlFormatter
+    import resource
 except ImportError:
-    have_pygments = False
+    have_resource = False
 
 
 class CocciException(Exception):
@@ -112,24 +200,581 @@ class CocciGrepConfig(PyConfigParser):
                 raise CocciException('No package config file: %s' % (filename))
 
 
-class CocciMatch:
+class CocciLineCache:
+    """
+    Cache of the lines of source files used for display
+
+    Files are read once and kept in memory until the total size of
+    cached files exceeds max_size bytes. Least recently used files are
+    evicted first.
+    """
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.files = OrderedDict()
+
+    def get(self, fname):
+        """
+        Get lines of a file
+
+        :param fname: name of the file
+        :type fname: str
+        :return: list of lines of the file
+        """
+        try:
+            (lines, fsize) = self.files.pop(fname)
+        except KeyError:
+            f = open(fname, 'r')
+            lines = f.readlines()
+            f.close()
+            fsize = sum(len(line) for line in lines)
+            self.size += fsize
+            while self.size > self.max_size and len(self.files):
+                self.size -= self.files.popitem(last=False)[1][1]
+        self.files[fname] = (lines, fsize)
+        return lines
+
+    def clear(self):
+        self.files.clear()
+        self.size = 0
+
+
+class CocciIndex:
+    """
+    Persistent index of the identifiers used in the files of a tree
+
+    The index is stored in a sqlite database at the root of the tree and
+    maps each C identifier to the files containing it. It is used to get
+    the files that may match a request without reading the whole tree.
+    It also keeps the modification times of all the directories walked
+    to build it so new files can be found without walking the tree again
+    (see :func:`refresh`).
+    """
+    filename = '.coccigrep.idx'
+    identifier_regexp = re.compile(b"[A-Za-z_][A-Za-z0-9_]*")
+
+    def __init__(self, directory):
+        if not _import_sqlite():
+            raise CocciConfigException("sqlite3 module is needed for index")
+        self.directory = directory
+        self.db = sqlite3.connect(path.join(directory, CocciIndex.filename))
+        # a deleted journal would change the modification time of the root
+        self.db.executescript("""
+PRAGMA journal_mode=PERSIST;
+CREATE TABLE IF NOT EXISTS dirs (name TEXT PRIMARY KEY, mtime REAL);
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, name TEXT UNIQUE,
+    mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS identifiers (id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS postings (identifier INTEGER, file INTEGER,
+    PRIMARY KEY (identifier, file));
+CREATE INDEX IF NOT EXISTS postings_file ON postings (file);
+""")
+
+    @staticmethod
+    def exists(directory):
+        """
+        :return: True if the directory contains an index
+        """
+        return path.isfile(path.join(directory, CocciIndex.filename))
+
+    def close(self):
+        self.db.close()
+
+    def build(self, finder):
+        """
+        Update the index with a walk of the whole tree
+
+        :param finder: finder used to walk the tree
+        :type finder: :class:`CocciFileFinder`
+        :return: number of files that have been (re)indexed
+        """
+        dirs = []
+        files = finder.walk(self.directory, dirs=dirs)
+        return self.update(files, dirs)
+
+    def update(self, files, dirs=None):
+        """
+        Update the index so it describes the list of files
+
+        Only files that are new or which have a different modification
+        time or size than in the index are read. Files of the index that
+        are not in the list are removed.
+
+        :param files: list of filenames below directory
+        :type files: list of str
+        :param dirs: names (relative to directory) of all the directories
+                     walked to get files, if it is not given the next
+                     :func:`refresh` walks the whole tree
+        :type dirs: list of str
+        :return: number of files that have been (re)indexed
+        """
+        indexed = {}
+        for (fid, name, mtime, size) in self.db.execute(
+                "SELECT id, name, mtime, size FROM files"):
+            indexed[name] = (fid, mtime, size)
+        identifiers = dict((name, iid) for (iid, name) in
+            self.db.execute("SELECT id, name FROM identifiers"))
+        updated = 0
+        names = set()
+        for fname in files:
+            name = path.relpath(fname, self.directory)
+            names.add(name)
+            try:
+                fstat = stat(fname)
+            except OSError:
+                continue
+            entry = indexed.get(name)
+            if entry is not None:
+                if entry[1:] == (fstat.st_mtime, fstat.st_size):
+                    continue
+                self._remove(entry[0])
+            with open(fname, 'rb') as f:
+                content = f.read()
+            cursor = self.db.execute("INSERT INTO files (name, mtime, size) "
+                "VALUES (?, ?, ?)", (name, fstat.st_mtime, fstat.st_size))
+            fid = cursor.lastrowid
+            postings = []
+            for ident in set(CocciIndex.identifier_regexp.findall(content)):
+                ident = ident.decode('utf8')
+                iid = identifiers.get(ident)
+                if iid is None:
+                    iid = self.db.execute("INSERT INTO identifiers (name) "
+                        "VALUES (?)", (ident, )).lastrowid
+                    identifiers[ident] = iid
+                postings.append((iid, fid))
+            self.db.executemany("INSERT INTO postings (identifier, file) "
+                "VALUES (?, ?)", postings)
+            updated += 1
+        for name in set(indexed.keys()) - names:
+            self._remove(indexed[name][0])
+        self._update_dirs(dirs or ())
+        self.db.commit()
+        return updated
+
+    def _dir_mtime(self, name):
+        """
+        :return: modification time of a directory or of its .gitignore
+                 file if it is more recent, None if it does not exist
+        """
+        dirname = path.join(self.directory, name)
+        try:
+            mtime = stat(dirname).st_mtime
+        except OSError:
+            return None
+        try:
+            return max(mtime, stat(path.join(dirname, '.gitignore')).st_mtime)
+        except OSError:
+            return mtime
+
+    def _update_dirs(self, dirs):
+        mtimes = dict((dname, self._dir_mtime(dname)) for dname in set(dirs))
+        if mtimes != dict(self.db.execute("SELECT name, mtime FROM dirs")):
+            self.db.execute("DELETE FROM dirs")
+            self.db.executemany("INSERT INTO dirs (name, mtime) VALUES "
+                "(?, ?)", mtimes.items())
+
+    def refresh(self, finder):
+        """
+        Update the index with the changes of the tree
+
+        Indexed files are checked with stat and the directories whose
+        modification time changed are walked again with the finder to
+        find new files. Their subdirectories are only walked if they are
+        new or if the directory has a .gitignore file whose rules may
+        have changed. An index without directory information is updated
+        with a walk of the whole tree.
+
+        :param finder: finder used to walk the changed directories
+        :type finder: :class:`CocciFileFinder`
+        :return: number of files that have been (re)indexed
+        """
+        dirs = dict(self.db.execute("SELECT name, mtime FROM dirs"))
+        if len(dirs) == 0:
+            return self.build(finder)
+        files = set(name for (name, ) in self.db.execute(
+            "SELECT name FROM files"))
+        # parents are walked before their subdirectories
+        for dname in sorted(dirs):
+            if dname not in dirs:
+                continue
+            mtime = self._dir_mtime(dname)
+            if mtime == dirs[dname]:
+                continue
+            known = dirs
+            if finder.use_git and path.isfile(path.join(self.directory,
+                    dname, '.gitignore')):
+                known = ()
+            walked = []
+            found = finder.walk(self.directory, dname, walked, known=known)
+            walked = set(walked)
+            # directories whose content has been listed
+            listed = set(sub for sub in walked
+                         if sub == dname or sub not in known)
+            # forget the directories which vanished or are now ignored
+            # with their content
+            if dname in walked:
+                gone = [sub for sub in dirs if sub != dname and
+                        path.dirname(sub) in listed and sub not in walked]
+            else:
+                gone = [dname]
+            for sub in gone:
+                prefix = sub + '/' if sub else ''
+                for name in list(dirs):
+                    if name == sub or name.startswith(prefix):
+                        del dirs[name]
+                files.difference_update([name for name in files
+                    if name.startswith(prefix)])
+            files.difference_update([name for name in files
+                if path.dirname(name) in listed])
+            files.update(path.relpath(fname, self.directory)
+                for fname in found)
+            for sub in listed:
+                dirs[sub] = self._dir_mtime(sub)
+        return self.update([path.join(self.directory, name)
+            for name in sorted(files)
+            if path.isfile(path.join(self.directory, name))], list(dirs))
+
+    def _remove(self, fid):
+        self.db.execute("DELETE FROM postings WHERE file = ?", (fid, ))
+        self.db.execute("DELETE FROM files WHERE id = ?", (fid, ))
+
+    def _files(self, query, args=()):
+        return sorted(path.join(self.directory, name) for (name, ) in
+            self.db.execute(query, args))
+
+    def files(self):
+        """
+        :return: list of all indexed files
+        """
+        return self._files("SELECT name FROM files")
+
+    def candidates(self, requirements):
+        """
+        Get the files that may match a request
+
+        :param requirements: list of lists of identifiers as returned by
+            :func:`CocciGrep.get_required_identifiers`
+        :return: list of files containing all the identifiers of at least
+                 one of the lists
+        """
+        if requirements is None:
+            return self.files()
+        names = set()
+        for identifiers in requirements:
+            query = " INTERSECT ".join(["SELECT file FROM postings "
+                "JOIN identifiers ON identifiers.id = postings.identifier "
+                "WHERE identifiers.name = ?"] * len(identifiers))
+            names.update(self._files("SELECT name FROM files WHERE id IN "
+                "(%s)" % query, identifiers))
+        return sorted(names)
+
+
+class _IgnoreRules:
+    """
+    Rules of the .gitignore files applying to a directory
+    """
+    def __init__(self, rules=()):
+        self.rules = rules
+
+    def load(self, dirname, rel):
+        """
+        :return: rules completed with the .gitignore file of dirname
+        """
+        try:
+            f = open(path.join(dirname, '.gitignore'), 'r')
+        except (IOError, OSError):
+            return self
+        rules = list(self.rules)
+        for line in f:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            # a leading or inner slash anchors the pattern
+            anchored = '/' in line
+            rules.append((rel, line.lstrip('/'), anchored, negate, dir_only))
+        f.close()
+        return _IgnoreRules(tuple(rules))
+
+    def ignored(self, rel, is_dir):
+        result = False
+        for (base, pattern, anchored, negate, dir_only) in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if base:
+                if not rel.startswith(base + '/'):
+                    continue
+                sub = rel[len(base) + 1:]
+            else:
+                sub = rel
+            if not anchored:
+                sub = path.basename(sub)
+            if fnmatch.fnmatchcase(sub, pattern):
+                result = not negate
+        return result
+
+
+class CocciFileFinder:
+    """
+    Find the source files in a list of directories
+
+    Directories are walked with scandir, each subdirectory of a directory
+    being walked in parallel. Files and directories matching one of the
+    exclude patterns (tested against the name and the path relative to
+    the walked directory) are skipped and so are the files ignored by
+    git. For a git checkout, the list of files is directly asked to git
+    (and to the git of its submodules) unless the directory is ignored.
+    """
+    default_excludes = ['.git', '.hg', '.svn']
+
+    def __init__(self, cpp=False, excludes=None, use_git=True, nthreads=8):
+        self.cpp = cpp
+        if excludes is None:
+            excludes = CocciFileFinder.default_excludes
+        self.excludes = excludes
+        self.exclude_regexp = None
+        if len(excludes):
+            self.exclude_regexp = re.compile("|".join(
+                fnmatch.translate(pattern) for pattern in excludes))
+        self.use_git = use_git
+        self.nthreads = nthreads
+
+    def is_source(self, fname):
+        return fname.endswith((".c", ".h")) or \
+            (self.cpp and fname.endswith(".cpp"))
+
+    def _excluded(self, name, rel):
+        if self.exclude_regexp is None:
+            return False
+        return self.exclude_regexp.match(name) is not None or \
+            self.exclude_regexp.match(rel) is not None
+
+    def _excluded_path(self, rel):
+        parts = rel.split('/')
+        for i in range(len(parts)):
+            if self._excluded(parts[i], '/'.join(parts[:i + 1])):
+                return True
+        return False
+
+    def find(self, directory):
+        """
+        Get source files below a directory
+
+        :param directory: name of the directory
+        :type directory: str
+        :return: sorted list of filenames
+        """
+        files = None
+        if self.use_git:
+            files = self._git_files(directory)
+        if files is None:
+            files = self._walk_files(directory)
+        return sorted(set(files))
+
+    def walk(self, directory, start='', dirs=None, known=()):
+        """
+        Get source files below a directory by walking it
+
+        git is not asked for the list of files but the rules of the
+        .gitignore files are applied as in :func:`find`.
+
+        :param directory: name of the directory
+        :type directory: str
+        :param start: subdirectory to walk (relative to directory), the
+                      rules of the .gitignore files of its parents apply
+        :type start: str
+        :param dirs: if not None, the names (relative to directory) of the
+                     walked directories are appended to it
+        :type dirs: list
+        :param known: names (relative to directory) of subdirectories
+                      which are appended to dirs but not walked
+        :return: sorted list of filenames
+        """
+        return sorted(set(self._walk_files(directory, start, dirs, known)))
+
+    def _git(self, directory, args):
+        """
+        :return: (exit code, output) of a git command or None if git can't
+                 be run
+        """
+        cmd = ['git', '-C', directory] + args
+        try:
+            errfile = open(devnull, 'w')
+            process = Popen(cmd, stdout=PIPE, stderr=errfile)
+            output = process.communicate()[0]
+            errfile.close()
+        except OSError:
+            return None
+        return (process.returncode, output)
+
+    def _git_files(self, directory):
+        """
+        :return: files of the directory listed by git or None if it is
+                 not in a git checkout or if it is ignored by git
+        """
+        # the user asked for an ignored directory: its content is only
+        # filtered by its own .gitignore files when walking it
+        result = self._git(directory, ['check-ignore', '-q', '.'])
+        if result is None or result[0] == 0:
+            return None
+        result = self._git(directory, ['ls-files', '-z', '--cached',
+            '--others', '--exclude-standard'])
+        if result is None or result[0] != 0:
+            return None
+        files = []
+        for rel in result[1].decode('utf8').split('\0'):
+            # untracked repositories are listed with a trailing slash
+            rel = rel.rstrip('/')
+            if not rel or self._excluded_path(rel):
+                continue
+            fname = path.join(directory, rel)
+            if self.is_source(rel):
+                # deleted files are still listed
+                if path.isfile(fname):
+                    files.append(fname)
+            elif path.exists(path.join(fname, '.git')) and \
+                    not path.islink(fname):
+                # checked out submodule or nested repository, listed by its
+                # own git
+                files += self.find(fname)
+        return files
+
+    def _walk_files(self, directory, start='', dirs=None, known=()):
+        if dirs is None:
+            dirs = []
+        if scandir is None:
+            files = []
+            top = path.join(directory, start) if start else directory
+            for dirpath, dirnames, filenames in walk(top):
+                rel = path.relpath(dirpath, directory)
+                rel = '' if rel == '.' else rel
+                dirs.append(rel)
+                for dirname in list(dirnames):
+                    if path.join(rel, dirname) in known:
+                        dirs.append(path.join(rel, dirname))
+                        dirnames.remove(dirname)
+                files += [path.join(dirpath, filename)
+                    for filename in filenames if self.is_source(filename)]
+            return files
+        rules = _IgnoreRules()
+        if start and self.use_git:
+            parts = start.split('/')
+            for i in range(len(parts)):
+                rel = '/'.join(parts[:i])
+                rules = rules.load(path.join(directory, rel) if rel
+                    else directory, rel)
+        # walk first level here and subdirectories in parallel
+        (files, subdirs) = self._scan(directory, start, rules, dirs, known)
+        if len(subdirs) > 1 and _import_futures():
+            with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+                for subfiles in executor.map(lambda subdir:
+                        self._walk(directory, [subdir], dirs, known), subdirs):
+                    files += subfiles
+        else:
+            files += self._walk(directory, subdirs, dirs, known)
+        return files
+
+    def _walk(self, directory, stack, dirs, known):
+        files = []
+        while len(stack):
+            (rel, rules) = stack.pop()
+            (subfiles, subdirs) = self._scan(directory, rel, rules, dirs,
+                known)
+            files += subfiles
+            stack += subdirs
+        return files
+
+    def _scan(self, directory, rel, rules, dirs, known):
+        """
+        :return: files of a directory and list of (subdirectory, rules)
+        """
+        dirname = path.join(directory, rel) if rel else directory
+        if self.use_git:
+            rules = rules.load(dirname, rel)
+        files = []
+        subdirs = []
+        try:
+            entries = list(scandir(dirname))
+        except OSError:
+            return (files, subdirs)
+        dirs.append(rel)
+        for entry in entries:
+            erel = rel + '/' + entry.name if rel else entry.name
+            if self._excluded(entry.name, erel):
+                continue
+            try:
+                is_dir = entry.is_dir() and not entry.is_symlink()
+            except OSError:
+                continue
+            if rules.ignored(erel, is_dir):
+                continue
+            if is_dir:
+                if erel in known:
+                    dirs.append(erel)
+                else:
+                    subdirs.append((erel, rules))
+            elif self.is_source(entry.name):
+                files.append(path.join(directory, erel))
+        return (files, subdirs)
+
+
+class CocciMatch(object):
     """
     Store a match and take care of its display
     """
 
+    __slots__ = ('file', 'line', 'column', 'lineend', 'columnend', 'search',
+                 'query', 'start_at', 'stop_at', 'trailer')
     ptype_regexp = re.compile("^[ )]*\.")
 
-    def __init__(self, mfile, mline, mcol, mlineend, mcolend, search):
+    def __init__(self, mfile, mline, mcol, mlineend, mcolend, search,
+                 query=None):
         self.file = mfile
         self.line = int(mline)
         self.column = int(mcol)
         self.lineend = int(mlineend)
         self.columnend = int(mcolend)
         self.search = search
+        self.query = query
         self.start_at = self.line
         self.stop_at = int(mlineend)
         self.trailer = ""
 
+    def _matched(self, lines):
+        pmatch = lines[self.line - 1][self.column:self.columnend]
+        ptype = "*"  # match is a pointer to struct
+        if (CocciMatch.ptype_regexp.search(lines[self.line - 1][self.columnend:])):
+            ptype = ""
+        return (pmatch, ptype)
+
+    def to_dict(self, lines=None):
+        """
+        Describe the match as a dict
+
+        :param lines: lines of the matched file (read from the line cache of
+                      the search if not given)
+        :type lines: list
+        :return: a dict with file, position, query and matched text of the
+                 match
+        """
+        if lines is None:
+            lines = self.search.line_cache.get(self.file)
+        (pmatch, ptype) = self._matched(lines)
+        query = self.query
+        if query is None:
+            query = self.search
+        return {'file': self.file, 'line': self.line,
+                'lineend': self.lineend, 'column': self.column,
+                'columnend': self.columnend, 'operation': query.operation,
+                'type': query.type, 'attribute': query.attribute,
+                'pointer': ptype == "*", 'match': pmatch,
+                'code': lines[self.line - 1].rstrip("\n")}
+
     def display(self, stype, mode='raw', oformat='term'):
         """
         Display output for a single match
@@ -143,21 +788,20 @@ class CocciMatch:
         :return: a human readable string containing the result of the search
                  (matched line, context, file name, etc.)
         """
-        f = open(self.file, 'r')
-        lines = f.readlines()
-        pmatch = lines[self.line - 1][self.column:self.columnend]
-        ptype = "*"  # match is a pointer to struct
-        if (CocciMatch.ptype_regexp.search(lines[self.line - 1][self.columnend:])):
-            ptype = ""
-        output = ""
+        lines = self.search.line_cache.get(self.file)
+        if mode == 'json':
+            import json
+            return json.dumps(self.to_dict(lines), sort_keys=True) + "\n"
         if mode == 'color':
-            output += "%s: l.%s -%d, l.%s +%d, %s %s%s\n" % (self.file,
-                 self.line, self.line - self.start_at, self.line,
-                 self.stop_at - self.line, stype, ptype, pmatch)
+            (output, pmatch) = self.color_text(stype, lines)
+            if oformat in CocciRenderer.formats and _import_pygments():
+                return CocciRenderer.get(oformat, inline=True).render(
+                    [(output, pmatch)])
+            return output + self.trailer
+        (pmatch, ptype) = self._matched(lines)
+        output = ""
         for i in range(self.start_at - 1, min(self.stop_at, len(lines))):
-            if mode == 'color':
-                output += lines[i]
-            elif mode == 'vim':
+            if mode == 'vim':
                 output += "%s|%s| (%s %s%s): %s" % (self.file, i + 1,
                 stype, ptype, pmatch, lines[i])
             elif mode == 'emacs':
@@ -165,8 +809,11 @@ class CocciMatch:
                 stype, ptype, pmatch, lines[i])
             elif mode == 'grep' and stdout.isatty():
                 lineend = lines[i][self.columnend:]
-                if self.search.attribute:
-                    lineend = lineend.replace(self.search.attribute, "\033[0;31m" + self.search.attribute + "\033[0m", 1)
+                attribute = self.search.attribute
+                if self.query is not None:
+                    attribute = self.query.attribute
+                if attribute:
+                    lineend = lineend.replace(attribute, "\033[0;31m" + attribute + "\033[0m", 1)
                 content = lines[i][:self.column] + \
                     "\033[0;32m" + lines[i][self.column:self.columnend] + "\033[0m" \
                     + lineend
@@ -178,56 +825,1362 @@ class CocciMatch:
             else:
                 output += "%s-%s %s - %s" % (self.file, i + 1,
                 ' ' * (2 + len(stype + ptype + pmatch)), lines[i])
-        f.close()
-        if mode == 'color':
-            if have_pygments:
-                lexer = CLexer()
-                lfilter = NameHighlightFilter(names=[pmatch])
-                lexer.add_filter(lfilter)
-                if oformat == "term":
-                    return highlight(output, lexer, Terminal256Formatter())
-                elif oformat == "html":
-                    return highlight(output, lexer,
-                        HtmlFormatter(noclasses=True))
-                else:
-                    return output
         return output + self.trailer
 
+    def color_text(self, stype, lines=None):
+        """
+        Build the text of the match to colorize
+
+        :param stype: name of the matched type
+        :type stype: str
+        :param lines: lines of the matched file (read from the line cache of
+                      the search if not given)
+        :type lines: list
+        :return: a tuple with the text to colorize and the matched name to
+                 highlight
+        """
+        if lines is None:
+            lines = self.search.line_cache.get(self.file)
+        (pmatch, ptype) = self._matched(lines)
+        output = "%s: l.%s -%d, l.%s +%d, %s %s%s\n" % (self.file,
+             self.line, self.line - self.start_at, self.line,
+             self.stop_at - self.line, stype, ptype, pmatch)
+        output += "".join(lines[self.start_at - 1:min(self.stop_at, len(lines))])
+        return (output, pmatch)
+
+
+class CocciMatchSet(object):
+    """
+    Compact store of the matches of a search
+
+    Matches are stored in columns: file names and queries are interned
+    and referenced by their index, positions are kept in arrays of
+    integers. A :class:`CocciMatch` is only built when a match is
+    accessed, so the set can hold millions of matches. The set can be
+    sorted, deduplicated and iterated by file, and display context can
+    be computed on the columns (see :func:`iter_context`).
+    """
+
+    __slots__ = ('search', 'files', 'file_ids', 'queries', 'query_ids',
+                 'fids', 'qids', 'lines', 'columns', 'lineends', 'columnends')
+
+    def __init__(self, search, matches=None):
+        self.search = search
+        self.files = []
+        self.file_ids = {}
+        self.queries = []
+        self.query_ids = {}
+        self._clear()
+        if matches is not None:
+            self.extend(matches)
+
+    def _clear(self):
+        self.fids = array('i')
+        self.qids = array('i')
+        self.lines = array('i')
+        self.columns = array('i')
+        self.lineends = array('i')
+        self.columnends = array('i')
+
+    def _columns(self):
+        return (self.fids, self.qids, self.lines, self.columns,
+                self.lineends, self.columnends)
+
+    def add(self, mfile, mline, mcol, mlineend, mcolend, query=None):
+        """
+        Add a match given by its position
+
+        :param query: query of the match in batch mode
+        :type query: :class:`CocciQuery`
+        """
+        fid = self.file_ids.get(mfile)
+        if fid is None:
+            fid = len(self.files)
+            self.files.append(mfile)
+            self.file_ids[mfile] = fid
+        qid = -1
+        if query is not None:
+            qid = self.query_ids.get(id(query))
+            if qid is None:
+                qid = len(self.queries)
+                self.queries.append(query)
+                self.query_ids[id(query)] = qid
+        self.fids.append(fid)
+        self.qids.append(qid)
+        self.lines.append(int(mline))
+        self.columns.append(int(mcol))
+        self.lineends.append(int(mlineend))
+        self.columnends.append(int(mcolend))
+
+    def append(self, match):
+        """
+        Add a match
+
+        :param match: the match
+        :type match: :class:`CocciMatch`
+        """
+        self.add(match.file, match.line, match.column, match.lineend,
+            match.columnend, match.query)
+
+    def extend(self, matches):
+        """
+        Add matches
+
+        :param matches: iterable of :class:`CocciMatch`
+        """
+        for match in matches:
+            self.append(match)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        """
+        :return: the :class:`CocciMatch` at index, or a list of them if
+                 index is a slice
+        """
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("match index out of range")
+        query = None
+        if self.qids[index] >= 0:
+            query = self.queries[self.qids[index]]
+        return CocciMatch(self.files[self.fids[index]], self.lines[index],
+            self.columns[index], self.lineends[index], self.columnends[index],
+            self.search, query)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def _key(self, index):
+        return (self.files[self.fids[index]], self.lines[index],
+                self.columns[index], self.lineends[index],
+                self.columnends[index], self.qids[index])
+
+    def _reorder(self, order):
+        columns = self._columns()
+        self._clear()
+        for (old, new) in zip(columns, self._columns()):
+            new.extend(old[index] for index in order)
+
+    def sort(self):
+        """
+        Sort matches by file, position and query
+        """
+        self._reorder(sorted(range(len(self)), key=self._key))
+
+    def dedupe(self):
+        """
+        Sort matches and remove duplicates
+        """
+        order = sorted(range(len(self)), key=self._key)
+        kept = []
+        prev_key = None
+        for index in order:
+            key = self._key(index)
+            if key != prev_key:
+                kept.append(index)
+            prev_key = key
+        self._reorder(kept)
+
+    def iter_files(self):
+        """
+        Iterate over matches grouped by file
+
+        Groups are made of contiguous matches of the same file: sort the
+        set first to get a single group per file.
+
+        :return: a generator of (filename, list of :class:`CocciMatch`)
+        """
+        start = 0
+        for index in range(1, len(self) + 1):
+            if index == len(self) or self.fids[index] != self.fids[start]:
+                yield (self.files[self.fids[start]],
+                       [self[i] for i in range(start, index)])
+                start = index
+
+    def iter_context(self, before=0, after=0):
+        """
+        Iterate over matches with display context set
+
+        Context lines are computed on the columns the same way
+        :func:`CocciGrep.iter_display` does on a stream of matches.
+
+        :param before: number of lines to display before match
+        :type before: int
+        :param after: number of lines to display after match
+        :type after: int
+        :return: a generator of :class:`CocciMatch`
+        """
+        count = len(self)
+        if before == 0 and after == 0:
+            for index in range(count):
+                yield self[index]
+            return
+        lines = self.lines
+        fids = self.fids
+        start_at = array('i', (max(1, line - before) for line in lines))
+        stop_at = array('i', (line + after for line in lines))
+        for index in range(count):
+            trailer = ""
+            following = index + 1
+            if following < count:
+                trailer = "--\n"
+                if fids[index] == fids[following]:
+                    if stop_at[index] >= lines[following]:
+                        stop_at[index] = lines[following] - 1
+                    if stop_at[index] >= start_at[following]:
+                        start_at[following] = stop_at[index] + 1
+                    if stop_at[index] + 1 == start_at[following]:
+                        # No separator if groups are contiguous
+                        trailer = ""
+            match = self[index]
+            match.start_at = start_at[index]
+            match.stop_at = stop_at[index]
+            match.trailer = trailer
+            yield match
+
+
+class CocciRenderer:
+    """
+    Colorize matches with pygments
+
+    Lexers and formatter are built once and reused for all matches. Text of
+    several matches is lexed separately but formatted in a single pass. In
+    html format, styles are given by classes defined in a single stylesheet
+    (see :func:`stylesheet`) unless inline styles are asked.
+    """
+
+    formats = ('term', 'html')
+    # maximum number of lexers kept (one per highlighted name)
+    max_lexers = 256
+    _renderers = {}
+
+    def __init__(self, oformat='term', inline=False):
+        if not _import_pygments():
+            raise CocciConfigException("Colorized output needs pygments")
+        if oformat not in CocciRenderer.formats:
+            raise CocciConfigException("Unknown output format '%s'" % (oformat))
+        self.oformat = oformat
+        if oformat == 'html':
+            self.formatter = HtmlFormatter(noclasses=inline)
+        else:
+            self.formatter = Terminal256Formatter()
+        self.lexers = {}
+
+    @classmethod
+    def get(cls, oformat='term', inline=False):
+        """
+        Get a renderer shared by all callers in the process
+
+        :param oformat: format of output (term, html)
+        :type oformat: str
+        :param inline: use inline styles in html format
+        :type inline: bool
+        :return: a :class:`CocciRenderer`
+        """
+        renderer = cls._renderers.get((oformat, inline))
+        if renderer is None:
+            renderer = CocciRenderer(oformat, inline)
+            cls._renderers[(oformat, inline)] = renderer
+        return renderer
+
+    def stylesheet(self):
+        """
+        :return: the style element to output before html blocks or an empty
+                 string in term format
+        """
+        if self.oformat != 'html':
+            return ""
+        return '<style type="text/css">\n%s\n</style>\n' % (
+            self.formatter.get_style_defs('.highlight'))
+
+    def _lexer(self, name):
+        lexer = self.lexers.get(name)
+        if lexer is None:
+            if len(self.lexers) >= CocciRenderer.max_lexers:
+                self.lexers.clear()
+            lexer = CLexer()
+            lexer.add_filter(NameHighlightFilter(names=[name]))
+            self.lexers[name] = lexer
+        return lexer
+
+    def render(self, snippets):
+        """
+        Colorize a list of snippets
+
+        :param snippets: list of tuples (text, highlighted name)
+        :type snippets: list
+        :return: the colorized output as a str
+        """
+        tokens = []
+        for (text, name) in snippets:
+            tokens.extend(self._lexer(name).get_tokens(text))
+        return format_tokens(tokens, self.formatter)
+
+
+def _render_snippets(job):
+    """
+    Colorize a group of snippets in a worker of a rendering pool
+    """
+    (oformat, snippets) = job
+    return CocciRenderer.get(oformat).render(snippets)
+
+
+class CocciQuery:
+    """
+    Store a search request
+
+    Queries are used to run several searches in a single spatch run
+    (see :func:`CocciGrep.setup_batch`).
+    """
+    def __init__(self, operation, stype, attribute=None):
+        self.operation = operation
+        self.type = stype
+        self.attribute = attribute
+
+    def label(self):
+        """
+        :return: a str identifying the query in output
+        """
+        return "%s: %s" % (self.operation, self.type)
+
+    def __str__(self):
+        if self.attribute:
+            return "%s:%s:%s" % (self.operation, self.type, self.attribute)
+        return "%s:%s" % (self.operation, self.type)
+
+
+class CocciStats:
+    """
+    Statistics about a run
+
+    Time is given in seconds. Each spatch run (one per batch of files in
+    parallel mode) is described by a worker record.
+    """
+    def __init__(self):
+        self.wall = 0.0
+        self.render_time = 0.0
+        self.parse_time = 0.0
+        self.display_time = 0.0
+        self.files = 0
+        self.spatch_files = 0
+        self.matches = 0
+        self.workers = []
+        self.quarantined = []
+
+    def add_worker(self, record):
+        self.workers.append(record)
+
+    def to_dict(self):
+        """
+        :return: statistics as a dict that can be serialized in JSON
+        """
+        failures = []
+        for record in self.workers:
+            failures += record.get('parse_failures', [])
+        return {'wall': self.wall, 'render': self.render_time,
+                'parse': self.parse_time, 'display': self.display_time,
+                'files': self.files, 'spatch_files': self.spatch_files,
+                'matches': self.matches,
+                'spatch_cpu': sum(record.get('cpu', 0.0)
+                    for record in self.workers),
+                'workers': self.workers, 'parse_failures': failures,
+                'quarantined': self.quarantined}
+
+
+class _PoolWorker:
+    """
+    A spatch process run by a :class:`CocciPool`
 
-class CocciProcess:
+    Error output is read when statistics are asked or when memory is
+    limited, to find out if spatch ran out of memory.
+    """
+    def __init__(self, bid, files, cmd, verbose, stats, memory_limit=0):
+        self.bid = bid
+        self.stats = stats
+        self.result = {}
+        if stats:
+            self.result = _batch_record(files)
+            self.start = time()
+        if verbose:
+            stderr.write("Running: %s.\n" % " ".join(cmd))
+        capture = stats or memory_limit > 0
+        errfile = None
+        if capture:
+            errfile = PIPE
+        elif not verbose:
+            errfile = open(devnull, 'w')
+        try:
+            self.process = Popen(cmd, stdout=PIPE, stderr=errfile,
+                preexec_fn=_memory_limiter(memory_limit))
+        finally:
+            if errfile not in (None, PIPE):
+                errfile.close()
+        self.result['timeout'] = False
+        self.output = b''
+        self.errors = b''
+        self.nlines = 0
+        self.streams = 1
+        if capture:
+            self.streams = 2
+        self.deadline = None
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+    def wait(self):
+        """
+        Reap the process and complete the result
+        """
+        usage = None
+        if hasattr(os, 'wait4') and self.process.returncode is None:
+            try:
+                (pid, status, usage) = os.wait4(self.process.pid, 0)
+                if os.WIFSIGNALED(status):
+                    self.process.returncode = -os.WTERMSIG(status)
+                else:
+                    self.process.returncode = os.WEXITSTATUS(status)
+            except OSError:
+                usage = None
+        self.process.wait()
+        self.process.stdout.close()
+        self.result['returncode'] = self.process.returncode
+        errors = self.errors.decode('utf8', 'replace').splitlines(True)
+        self.result['memory'] = _out_of_memory(self.result, errors)
+        if self.process.stderr is not None:
+            self.process.stderr.close()
+        if self.stats:
+            cpu = 0.0
+            if usage is not None:
+                cpu = usage.ru_utime + usage.ru_stime
+            self.result.update({'wall': time() - self.start, 'cpu': cpu,
+                'lines': self.nlines,
+                'parse_failures': _parse_failures(errors)})
+        return self.result
+
+
+# same value as selectors.EVENT_READ
+_EVENT_READ = 1
+
+
+class _SelectKey(object):
+    __slots__ = ('fileobj', 'data')
+
+    def __init__(self, fileobj, data):
+        self.fileobj = fileobj
+        self.data = data
+
+
+class _PollSelector:
     """
-    Class used for running spatch command in the case of multiprocessing
+    Minimal replacement of selectors.DefaultSelector for python 2
+
+    Only waiting for file objects to be readable is supported. poll is
+    used when the system has it, select otherwise.
     """
-    def __init__(self, cmd, verbose):
-        self.process = Process(target=self.execute, args=(self, ))
-        self.output, self.input = Pipe()
+    def __init__(self):
+        self.keys = {}
+        self.poller = None
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+
+    def register(self, fileobj, events, data=None):
+        key = _SelectKey(fileobj, data)
+        self.keys[fileobj.fileno()] = key
+        if self.poller is not None:
+            self.poller.register(fileobj.fileno(),
+                select.POLLIN | select.POLLPRI)
+        return key
+
+    def unregister(self, fileobj):
+        key = self.keys.pop(fileobj.fileno())
+        if self.poller is not None:
+            self.poller.unregister(key.fileobj.fileno())
+        return key
+
+    def select(self, timeout=None):
+        if self.poller is not None:
+            if timeout is not None:
+                timeout = int(timeout * 1000) + 1
+            fds = [fd for (fd, event) in self.poller.poll(timeout)]
+        else:
+            fds = select.select(list(self.keys), [], [], timeout)[0]
+        return [(self.keys[fd], _EVENT_READ) for fd in fds
+                if fd in self.keys]
+
+    def close(self):
+        self.keys.clear()
+        self.poller = None
+
+
+def _new_selector():
+    if _import_selectors():
+        return selectors.DefaultSelector()
+    return _PollSelector()
+
+
+class CocciPool:
+    """
+    Run spatch on batches of files with a pool of spatch processes
+
+    At most size spatch processes run at the same time, the other
+    batches wait in a queue. Outputs of the processes are read without
+    blocking and split in lines as they arrive, so only incomplete lines
+    are kept in memory. A process running for more than timeout seconds
+    (0 for no limit) is killed. If memory_budget is not 0, the address
+    space of each process is limited to its share of memory_budget bytes,
+    but never to less than child_memory bytes.
+    """
+    chunk_size = 65536
+
+    def __init__(self, cmd, size, verbose=False, stats=False, timeout=0,
+                 memory_budget=0, child_memory=0):
         self.cmd = cmd
+        self.size = size
         self.verbose = verbose
+        self.stats = stats
+        self.timeout = timeout
+        self.memory_budget = memory_budget
+        self.child_memory = child_memory
+        self.waiting = deque()
+        self.running = []
+        self.selector = _new_selector()
+
+    def submit(self, bid, files, includes=None):
+        """
+        Queue a batch of files
 
-    def execute(self, option=''):
-        output = ""
+        :param bid: identifier of the batch
+        :param files: list of filenames
+        :type files: list of str
+        :param includes: include options of the batch
+        :type includes: list of str
+        """
+        self.waiting.append((bid, files, includes or []))
+
+    def shrink(self):
+        """
+        Halve the number of processes run at the same time so the next
+        ones get more memory
+
+        :return: the new number of processes
+        """
+        self.size = max(1, self.size // 2)
+        return self.size
+
+    def _start(self, bid, files, includes):
+        cmd = self.cmd + includes + files
+        memory_limit = 0
+        if self.memory_budget:
+            memory_limit = max(self.memory_budget // self.size,
+                self.child_memory)
         try:
+            worker = _PoolWorker(bid, files, cmd, self.verbose, self.stats,
+                memory_limit)
+        except OSError as err:
+            _raise_run_err(err, cmd)
+        if self.timeout > 0:
+            worker.deadline = time() + self.timeout
+        self.selector.register(worker.process.stdout, _EVENT_READ,
+            (worker, 'output'))
+        if worker.process.stderr is not None:
+            self.selector.register(worker.process.stderr, _EVENT_READ,
+                (worker, 'errors'))
+        self.running.append(worker)
+
+    def _read(self, worker, stream, fileobj):
+        data = os.read(fileobj.fileno(), self.chunk_size)
+        if stream == 'errors':
             if self.verbose:
-                stderr.write("Running: %s.\n" % " ".join(self.cmd))
-                output = Popen(self.cmd, stdout=PIPE).communicate()[0]
-            else:
-                output = Popen(self.cmd, stdout=PIPE,
-                    stderr=PIPE).communicate()[0]
-        except Exception as err:
-            import json
-            output = json.dumps(err)
+                stderr.write(data.decode('utf8', 'replace'))
+            worker.errors += data
+        else:
+            worker.output += data
+        if len(data) == 0:
+            self.selector.unregister(fileobj)
+            worker.streams -= 1
+            if stream == 'output' and len(worker.output):
+                # last line without end of line
+                return [worker.output]
+            return []
+        if stream == 'errors':
+            return []
+        lines = worker.output.split(b'\n')
+        worker.output = lines.pop()
+        return [line + b'\n' for line in lines]
+
+    def events(self):
+        """
+        Run the queued batches (including the ones queued while running)
+
+        :return: a generator of (batch id, line, None) for each line of
+                 output and of (batch id, None, result) when spatch ends,
+                 result being a dict with returncode and timeout keys
+                 (and statistics if asked, see :func:`_spatch_lines`)
+        :raise: :class:`CocciRunException` if spatch can't be run
+        """
+        while len(self.waiting) or len(self.running):
+            while len(self.waiting) and len(self.running) < self.size:
+                self._start(*self.waiting.popleft())
+            wait = None
+            deadlines = [worker.deadline for worker in self.running
+                         if worker.deadline is not None]
+            if len(deadlines):
+                wait = max(0, min(deadlines) - time())
+            for (key, mask) in self.selector.select(wait):
+                (worker, stream) = key.data
+                for line in self._read(worker, stream, key.fileobj):
+                    worker.nlines += 1
+                    yield (worker.bid, line, None)
+            now = time()
+            for worker in list(self.running):
+                if worker.deadline is not None and now >= worker.deadline \
+                        and worker.streams > 0:
+                    worker.result['timeout'] = True
+                    worker.deadline = None
+                    worker.kill()
+                if worker.streams == 0:
+                    self.running.remove(worker)
+                    yield (worker.bid, None, worker.wait())
+
+    def close(self):
+        """
+        Kill running spatch processes and forget queued batches
+        """
+        self.waiting.clear()
+        for worker in self.running:
+            worker.kill()
+            for fileobj in (worker.process.stdout, worker.process.stderr):
+                if fileobj is not None and not fileobj.closed:
+                    try:
+                        self.selector.unregister(fileobj)
+                    except (KeyError, ValueError):
+                        pass
+            worker.wait()
+        self.running = []
+        self.selector.close()
+
+
+def _batch_record(files):
+    size = 0
+    for fname in files:
+        try:
+            size += stat(fname).st_size
+        except OSError:
+            pass
+    return {'files': len(files), 'bytes': size}
+
+
+_parse_error = re.compile(r"^\s*=?\s*File \"(.*)\", line (\d+)")
+
+
+def _parse_failures(lines):
+    """
+    Get the files spatch failed to parse from its error output
+    """
+    failures = []
+    in_error = False
+    for line in lines:
+        if "parse error" in line or "PARSING ERROR" in line:
+            in_error = True
+            continue
+        m = _parse_error.match(line)
+        if in_error and m:
+            failures.append({'file': m.group(1), 'line': int(m.group(2))})
+            in_error = False
+    return failures
+
+
+def _spatch_lines(cmd, verbose, result=None, stats=False, timeout=0,
+                  memory_limit=0):
+    """
+    Run spatch command and yield lines of its output as they arrive
+
+    The result dict is completed with the return code of spatch, a
+    timeout key telling if spatch has been killed because it was running
+    for more than timeout seconds (0 for no limit) and a memory key
+    telling if it ran out of memory (its address space is limited to
+    memory_limit bytes, 0 for no limit). If stats is True, it also gets
+    statistics about the run: wall and CPU time, number of lines output
+    and list of files spatch failed to parse.
+    """
+    if result is None:
+        result = {}
+    if verbose:
+        stderr.write("Running: %s.\n" % " ".join(cmd))
+    capture = stats or memory_limit > 0
+    errfile = None
+    if capture:
+        errfile = PIPE
+    elif not verbose:
+        errfile = open(devnull, 'w')
+    if stats:
+        start = time()
+        usage = _children_cpu_time()
+    try:
+        process = Popen(cmd, stdout=PIPE, stderr=errfile,
+            preexec_fn=_memory_limiter(memory_limit))
+    finally:
+        if errfile not in (None, PIPE):
+            errfile.close()
+    result['timeout'] = False
+    watchdog = None
+    if timeout > 0:
+        def kill():
+            result['timeout'] = True
+            process.kill()
+        watchdog = Timer(timeout, kill)
+        watchdog.start()
+    errors = []
+    if capture:
+        # read errors in a thread to avoid dead lock on full pipe
+        error_reader = Thread(target=_read_errors,
+            args=(process.stderr, errors, verbose))
+        error_reader.start()
+    nlines = 0
+    try:
+        for line in iter(process.stdout.readline, b''):
+            nlines += 1
+            yield line
+        process.wait()
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        result['returncode'] = process.returncode
+        if capture:
+            error_reader.join()
+            process.stderr.close()
+        result['memory'] = _out_of_memory(result, errors)
+        if stats:
+            result.update({'wall': time() - start,
+                'cpu': _children_cpu_time() - usage, 'lines': nlines,
+                'parse_failures': _parse_failures(errors)})
+
+
+_out_of_memory_error = re.compile(
+    r"^Fatal error: (exception Out_of_memory|out of memory)")
+
+
+def _out_of_memory(result, errors):
+    """
+    Tell if spatch failed because it ran out of memory or has been killed
+    by the kernel (which uses SIGKILL when memory is exhausted)
+
+    :param result: result of the run with returncode and timeout keys
+    :param errors: lines of the error output of spatch (if read)
+    """
+    import signal
+    if result['timeout'] or result['returncode'] == 0:
+        return False
+    if result['returncode'] == -signal.SIGKILL:
+        return True
+    for line in errors:
+        if _out_of_memory_error.match(line):
+            return True
+    return False
+
+
+def _memory_limiter(limit):
+    """
+    Get the function limiting the address space of a child process to
+    limit bytes, None if there is no limit
+    """
+    if limit <= 0 or not have_resource:
+        return None
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+
+    def set_limit():
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    return set_limit
+
+
+def _cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    try:
+        return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+def _available_memory():
+    """
+    Get the memory which can be used by new processes without swapping,
+    taking the memory limit of the control group into account
+
+    :return: size in bytes or None if it is unknown
+    """
+    available = None
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if available is None:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') * \
+                os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            pass
+    try:
+        with open('/sys/fs/cgroup/memory.max', 'r') as limit_file:
+            limit = limit_file.read().strip()
+        with open('/sys/fs/cgroup/memory.current', 'r') as current_file:
+            current = int(current_file.read())
+        if limit != 'max':
+            left = max(0, int(limit) - current)
+            if available is None or left < available:
+                available = left
+    except (IOError, OSError, ValueError):
+        pass
+    return available
+
+
+def _auto_concurrency(child_memory):
+    """
+    Get the number of spatch processes the host can run
+
+    :param child_memory: memory expected to be used by a spatch process
+    :return: (number of processes, memory available for them in bytes or
+              0 if it is unknown or too small for a single process)
+    """
+    ncpus = _cpu_count()
+    memory = _available_memory()
+    if memory is None:
+        return (ncpus, 0)
+    if memory < child_memory:
+        stderr.write("Warning: only %d MiB of memory available, not limiting "
+            "memory of spatch.\n" % (memory // (1024 * 1024)))
+        return (1, 0)
+    return (max(1, min(ncpus, memory // child_memory)), memory)
+
+
+def _read_errors(errfile, errors, verbose):
+    for line in iter(errfile.readline, b''):
+        line = line.decode('utf8', 'replace')
+        if verbose:
+            stderr.write(line)
+        errors.append(line)
+
+
+def _children_cpu_time():
+    if not have_resource:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+_rule_decl = re.compile(r"^@\s*(\w+)\s*(:?)", re.M)
+_rule_header = re.compile(r"^@[^@\n]+@[ \t]*$", re.M)
+
+
+def _output_key(line, tagged):
+    """
+    Get the sort key of a line of spatch output
+
+    :return: (file, line, column, line end, column end, tag) or None if
+             the line is not a match
+    """
+    try:
+        fields = line.decode('utf8').rstrip("\n").rsplit(":", 4)
+        tag = ""
+        if tagged:
+            (tag, fields[0]) = fields[0].split(":", 1)
+        return (fields[0], int(fields[1]), int(fields[2]), int(fields[3]),
+                int(fields[4]), tag)
+    except (ValueError, IndexError):
+        return None
+
+
+def _parse_match(line, search, queries):
+    """
+    Build the match of a line of spatch output
+
+    :param queries: queries of the run, empty if output is not tagged
+    :return: a :class:`CocciMatch` or None if the line is not a match
+    """
+    try:
+        fields = line.decode('utf8').rstrip("\n").split(":")
+        query = None
+        if len(queries):
+            query = queries[int(fields.pop(0)[1:])]
+        (efile, eline, ecol, elinend, ecolend) = fields
+        return CocciMatch(efile, eline, ecol, elinend, ecolend, search, query)
+    except (ValueError, IndexError):
+        return None
+
+
+def _rename_rules(cocci_smpl, suffix):
+    """
+    Add suffix to the name of all the rules of a semantic patch
+
+    Declarations, dependencies and inherited metavariables are renamed
+    so that several semantic patches can be concatenated.
+    """
+    for (name, script) in _rule_decl.findall(cocci_smpl):
+        if script:
+            continue
+        name_regexp = re.compile(r"\b%s\b" % name)
+        cocci_smpl = _rule_header.sub(lambda header:
+            name_regexp.sub(name + suffix, header.group(0)), cocci_smpl)
+        cocci_smpl = re.sub(r"(?<![\w.>])%s\.(?=\w)" % name,
+            name + suffix + ".", cocci_smpl)
+    return cocci_smpl
+
+
+def _file_contains(fname, identifiers):
+    """
+    Check if a file contains all the identifiers
+
+    :param identifiers: list of (identifier, compiled regexp) tuples
+    """
+    try:
+        with open(fname, 'rb') as f:
+            if stat(fname).st_size == 0:
+                return False
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # let spatch report the problem
+        return True
+    try:
+        for (ident, ident_regexp) in identifiers:
+            # find is a lot faster than a regexp search and is enough
+            # to discard most files
+            if content.find(ident) == -1 or \
+                    not ident_regexp.search(content):
+                return False
+        return True
+    finally:
+        content.close()
+
+
+def _include_options(files, headers=()):
+    """
+    Get -I options for the directories of files and of their headers
+    """
+    options = []
+    seen = set()
+    for fname in list(files) + sorted(headers):
+        include_dir = path.dirname(fname)
+        if len(include_dir) and include_dir not in seen:
+            seen.add(include_dir)
+            options += ["-I", include_dir]
+    return options
+
+
+def _git_output(directory, args):
+    cmd = ['git', '-C', directory] + args
+    try:
+        process = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        (output, error) = process.communicate()
+    except OSError as err:
+        raise CocciRunException("Unable to run git: %s" % (err.strerror))
+    if process.returncode != 0:
+        raise CocciRunException("git %s failed in '%s': %s" % (args[0],
+            directory, error.decode('utf8', 'replace').strip()))
+    return output.decode('utf8')
+
+
+def _git_changed_files(top, since):
+    """
+    Get the real paths of the files of a git checkout changed since a
+    revision, including uncommitted changes and untracked files
+    """
+    output = _git_output(top, ['diff', '--name-only', '-z', since, '--'])
+    output += _git_output(top, ['ls-files', '-z', '--others',
+        '--exclude-standard'])
+    changed = set()
+    for rel in output.split('\0'):
+        fname = path.join(top, rel)
+        if len(rel) and path.isfile(fname):
+            changed.add(path.realpath(fname))
+    return changed
+
+
+def _make_batches(files, batch_size):
+    """
+    Split list of files in batches of contiguous files
+
+    A new batch is started as soon as the current one contains
+    batch_size bytes so big files end up in small batches.
+    """
+    batches = []
+    current = []
+    current_size = 0
+    for fname in files:
+        current.append(fname)
+        try:
+            current_size += stat(fname).st_size
+        except OSError:
+            pass
+        if current_size >= batch_size:
+            batches.append(current)
+            current = []
+            current_size = 0
+    if len(current):
+        batches.append(current)
+    return batches
+
+
+def _make_include_batches(files, batch_size, graph):
+    """
+    Split list of files in batches of files sharing their headers
+
+    Files are ordered by directory then by set of included headers
+    before being split like :func:`_make_batches` does, so headers are
+    parsed by as few spatch commands as possible.
+
+    :return: list of (files, headers) tuples, headers being the set of
+             headers included by the files of the batch
+    """
+    closures = graph.closures(files)
+    ordered = sorted(files, key=lambda fname: (path.dirname(fname),
+        sorted(closures[fname]), fname))
+    batches = []
+    for sub_files in _make_batches(ordered, batch_size):
+        headers = set()
+        for fname in sub_files:
+            headers.update(closures[fname])
+        batches.append((sub_files, headers))
+    return batches
+
+
+_include_regexp = re.compile(br'^[ \t]*#[ \t]*include[ \t]*"([^"\n]+)"', re.M)
+
+
+def _file_includes(fname):
+    """
+    Get the names of the files included with quotes by a file
+    """
+    try:
+        with open(fname, 'rb') as f:
+            content = f.read()
+    except (IOError, OSError):
+        return []
+    return [name.decode('utf8', 'replace')
+            for name in _include_regexp.findall(content)]
+
+
+class CocciIncludeGraph:
+    """
+    Include relations between source files
+
+    Only includes with quotes are followed. They are resolved relatively
+    to the directory of the including file, then to the include
+    directories. Each file is read at most once.
+    """
+    def __init__(self, include_dirs=None, nthreads=4):
+        self.include_dirs = include_dirs or []
+        self.nthreads = nthreads
+        self.includes = {}
+
+    def _resolve(self, name, fdir):
+        for directory in [fdir] + self.include_dirs:
+            candidate = path.normpath(path.join(directory, name))
+            if path.isfile(candidate):
+                return candidate
+        return None
+
+    def _scan(self, fname):
+        resolved = []
+        fdir = path.dirname(fname)
+        for name in _file_includes(fname):
+            header = self._resolve(name, fdir)
+            if header is not None and header not in resolved:
+                resolved.append(header)
+        return resolved
+
+    def included(self, fname):
+        """
+        :return: list of the files directly included by fname
+        """
+        if fname not in self.includes:
+            self.includes[fname] = self._scan(fname)
+        return self.includes[fname]
+
+    def closure(self, fname):
+        """
+        :return: set of the files included by fname directly or not
+        """
+        seen = set()
+        todo = [fname]
+        while len(todo):
+            for header in self.included(todo.pop()):
+                if header not in seen:
+                    seen.add(header)
+                    todo.append(header)
+        return seen
+
+    def closures(self, files):
+        """
+        Get include closures of a list of files
+
+        Files are read in parallel when possible.
+
+        :return: dict of sets of included files indexed by filename
+        """
+        todo = [fname for fname in files if fname not in self.includes]
+        if len(todo) > 1 and _import_futures():
+            with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+                for (fname, resolved) in zip(todo, executor.map(self._scan, todo)):
+                    self.includes[fname] = resolved
+        return dict((fname, self.closure(fname)) for fname in files)
+
+
+def _find_executable(cmd):
+    """
+    Get the resolved path of a command
+
+    :return: path of the command or None if it can not be found
+    """
+    if path.dirname(cmd):
+        candidates = [cmd]
+    else:
+        candidates = [path.join(dirname, cmd) for dirname in
+            environ.get('PATH', '').split(pathsep)]
+    for candidate in candidates:
+        if path.isfile(candidate) and access(candidate, X_OK):
+            return path.realpath(candidate)
+    return None
+
+
+def _version_key(version):
+    """
+    Get a key that can be used to compare versions
+
+    Numbers are compared numerically and a version with a textual
+    component (like 1.0.0-rc6) is older than the same version
+    without it (1.0.0).
+    """
+    key = []
+    for part in re.findall(r"\d+|[a-zA-Z]+", version):
+        if part.isdigit():
+            key.append((1, int(part)))
+        else:
+            key.append((-1, part.lower()))
+    key.append((0, ''))
+    return key
+
+
+def _default_cache_dir():
+    cache_home = environ.get('XDG_CACHE_HOME',
+        path.join(path.expanduser('~'), '.cache'))
+    return path.join(cache_home, 'coccigrep')
+
+
+def _write_atomic(fname, data):
+    """
+    Write data (bytes) to a file so that readers never see it partially
+    written, creating its directory if needed
+
+    The data is written in a temporary file with a unique name in the
+    same directory which is then renamed, so concurrent writers (in
+    other processes or threads) don't share their temporary file.
+
+    :raise: IOError or OSError
+    """
+    from tempfile import mkstemp
+    directory = path.dirname(fname)
+    if not path.isdir(directory):
+        makedirs(directory)
+    (fd, tmp_name) = mkstemp(dir=directory,
+        prefix='.%s.' % path.basename(fname))
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        rename(tmp_name, fname)
+    except (IOError, OSError):
+        try:
+            unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+def _hash(*items):
+    import hashlib
+    digest = hashlib.sha1()
+    for item in items:
+        digest.update(item.encode('utf8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class CocciMatchCache:
+    """
+    On disk cache of the matches found in a file
+
+    Entries are stored per query key (a hash of the semantic patch, of the
+    spatch version and of the spatch options) and per file. An entry
+    also keeps the matches found in headers when spatch parsed the file.
+    It is valid as long as the modification time and the size of the file
+    and of the headers it includes (see :class:`CocciIncludeGraph`) are
+    unchanged.
+    """
+    def __init__(self, cache_dir, key):
+        self.directory = path.join(cache_dir, 'matches', key)
+        # file ids are read once per run
+        self.ids = {}
+
+    def _entry_name(self, fname):
+        return path.join(self.directory, _hash(path.abspath(fname)) + '.json')
+
+    def _file_id(self, fname):
+        if fname not in self.ids:
+            fstat = stat(fname)
+            self.ids[fname] = [fstat.st_mtime, fstat.st_size]
+        return self.ids[fname]
+
+    def lookup(self, fname):
+        """
+        Get cached matches for a file
+
+        :param fname: name of the file
+        :type fname: str
+        :return: (list of (line, column, line end, column end), list of
+                 (file, line, column, line end, column end) in headers,
+                 file being relative to the directory of fname) or None if
+                 there is no valid entry for the file
+        """
+        import json
+        try:
+            with open(self._entry_name(fname), 'r') as entry_file:
+                entry = json.load(entry_file)
+            if entry['id'] != self._file_id(fname):
+                return None
+            for (header, header_id) in entry['deps']:
+                if self._file_id(header) != header_id:
+                    return None
+            return (entry['matches'], entry['foreign'])
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def store(self, fname, positions, foreign=None, deps=()):
+        """
+        Store the matches found in a file
+
+        :param fname: name of the file
+        :type fname: str
+        :param positions: list of (line, column, line end, column end)
+        :type positions: list of tuple
+        :param foreign: list of (file, line, column, line end, column end)
+            of the matches found in headers when parsing the file, file
+            being relative to the directory of fname
+        :type foreign: list of tuple
+        :param deps: headers included by the file
+        :type deps: iterable of str
+        """
+        import json
+        entry_name = self._entry_name(fname)
+        try:
+            entry = {'id': self._file_id(fname), 'matches': positions,
+                     'foreign': foreign or [],
+                     'deps': [[path.abspath(header), self._file_id(header)]
+                              for header in sorted(deps)]}
+            _write_atomic(entry_name, json.dumps(entry).encode('utf8'))
+        except (IOError, OSError):
+            # cache is only an optimisation, ignore write failures
+            pass
+
+
+class CocciPatchCache:
+    """
+    Content addressed store of rendered semantic patches
+
+    Patches are stored in files named after a hash of what they are
+    rendered from, so identical requests share the same file across
+    runs, servers and workers. When the store gets bigger than max_size
+    bytes, the least recently used patches are removed.
+    """
+    max_size = 16 * 1024 * 1024
+
+    def __init__(self, cache_dir, max_size=None):
+        self.directory = path.join(cache_dir, 'patches')
+        if max_size is not None:
+            self.max_size = max_size
+
+    def _patch_name(self, key):
+        return path.join(self.directory, key + '.cocci')
+
+    def lookup(self, key):
+        """
+        Get the file of a rendered semantic patch
 
-        self.input.send(output)
-        self.input.close()
+        :param key: hash identifying the semantic patch
+        :type key: str
+        :return: name of the file or None if patch is not in store
+        """
+        patch_name = self._patch_name(key)
+        try:
+            # mark as recently used
+            utime(patch_name, None)
+        except OSError:
+            return None
+        return patch_name
 
-    def start(self):
-        self.process.start()
+    def store(self, key, content):
+        """
+        Write a rendered semantic patch in the store
 
-    def join(self):
-        self.process.join()
+        :param key: hash identifying the semantic patch
+        :type key: str
+        :param content: the semantic patch
+        :type content: str
+        :return: name of the file or None if it can't be written
+        """
+        patch_name = self._patch_name(key)
+        try:
+            _write_atomic(patch_name, content.encode('utf8'))
+        except (IOError, OSError):
+            return None
+        self.cleanup()
+        return patch_name
 
-    def recv(self):
-        return self.output.recv()
+    def cleanup(self):
+        """
+        Remove least recently used patches until the store is smaller
+        than max_size
+        """
+        entries = []
+        total_size = 0
+        try:
+            names = listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.cocci'):
+                continue
+            patch_name = path.join(self.directory, name)
+            try:
+                pstat = stat(patch_name)
+            except OSError:
+                continue
+            entries.append((pstat.st_mtime, pstat.st_size, patch_name))
+            total_size += pstat.st_size
+        entries.sort()
+        # always keep the most recent one
+        while total_size > self.max_size and len(entries) > 1:
+            (mtime, size, patch_name) = entries.pop(0)
+            try:
+                unlink(patch_name)
+            except OSError:
+                pass
+            total_size -= size
 
 
 def _operation_name(fname):
@@ -249,21 +2202,33 @@ class CocciPatch:
     This class is iterable and can be used as a dictionnary.
     """
 
-    keywords = ["Name", "Author", "Desc", "Confidence", "File", "Revision", "Arguments"]
+    keywords = ["Name", "Author", "Desc", "Confidence", "File", "Revision", "Arguments", "Prefilter"]
     comment = re.compile("^ *// *(%s): (.*)" % ("|".join(keywords)))
 
-    def __init__(self, filename):
-        # open file
+    def __init__(self, filename, headers=None):
         self.__dict__["File"] = filename
         self.__dict__["Name"] = _operation_name(filename)
-        # read file
-        f = open(filename, 'r')
-        lines = f.readlines()
-        # match
-        for line in lines:
-            mm = CocciPatch.comment.match(line)
-            if mm:
-                self.__dict__[mm.group(1)] = mm.group(2)
+        if headers is None:
+            headers = CocciPatch.read_headers(filename)
+        for (key, value) in headers:
+            self.__dict__[key] = value
+
+    @staticmethod
+    def read_headers(filename):
+        """
+        Read the // Keyword: value headers of a semantic patch
+
+        :param filename: name of the semantic patch
+        :type filename: str
+        :return: list of (keyword, value) in file order
+        """
+        headers = []
+        with open(filename, 'r') as f:
+            for line in f:
+                mm = CocciPatch.comment.match(line)
+                if mm:
+                    headers.append((mm.group(1), mm.group(2)))
+        return headers
 
     def __iter__(self):
         """ return iterator over keys """
@@ -302,6 +2267,14 @@ class CocciGrep:
     of initialisation and running of the request.
     """
     spatch = "spatch"
+    sharding_strategies = ('size', 'include')
+    # maximum number of matches colorized in a single pass
+    render_group_size = 256
+    # number of colorized matches above which a pool of processes is used
+    render_pool_threshold = 2048
+    # memory expected to be used by a spatch process, used to compute the
+    # automatic concurrency level
+    child_memory = 1024 * 1024 * 1024
     cocci_python_hdr_std = """
 @ script:python @
 """
@@ -318,14 +2291,44 @@ for p in p1:
     print("%s:%s:%s:%s:%s" % (p.file,p.line,p.column,p.line_end,p.column_end))
 """
 
+    cocci_python_hdr_tagged = Template("""
+@ script:python $dependency@
+""")
+    cocci_python_tagged = Template("""
+
+p1 << init_$tag.p1;
+@@
+
+for p in p1:
+    print("$tag:%s:%s:%s:%s:%s" % (p.file,p.line,p.column,p.line_end,p.column_end))
+""")
+
     def __init__(self):
         self.verbose = False
         self.spatch = CocciGrep.spatch
+        self.spatch_version = None
         self.ncpus = 1
+        self.memory_budget = 0
+        self.batch_size = 0
         self.operations = {}
-        self.process = []
-        self.matches = []
+        self.matches = CocciMatchSet(self)
+        self.queries = []
+        self.line_cache = CocciLineCache()
         self.options = ["--recursive-includes"]
+        self.cache_dir = None
+        self.match_cache = False
+        self.prefilter = False
+        self.stats = None
+        self.timeout = 0
+        self.max_count = 0
+        self.skip_list = set()
+        self.skip_list_file = None
+        self.quarantined = []
+        self.excludes = CocciFileFinder.default_excludes
+        self.use_git = True
+        self.sharding = 'size'
+        self.templates = {}
+        self.operation_index = None
         dirList = listdir(self.get_datadir())
         for fname in dirList:
             op = _operation_name(fname)
@@ -345,18 +2348,94 @@ for p in p1:
         self.type = stype
         self.attribute = attribute
         self.operation = operation
+        self.queries = []
+
+    def setup_batch(self, queries):
+        """
+        Setup several searches to be done in a single run
+
+        The semantic patches of all queries are merged so each file
+        is parsed only once. Each match is tagged with the query it
+        belongs to in its query attribute.
+
+        :param queries: list of queries
+        :type queries: list of :class:`CocciQuery`
+        """
+        self.queries = queries
+        self.type = None
+        self.attribute = None
+        self.operation = None
 
     def set_concurrency(self, ncpus):
         """
         Set concurrency level (number of spatch command to run in parallel)
 
-        :param ncpus: number of process to launch in parallel
-        :type ncpus: int
+        With 'auto', the level is computed from the number of CPUs and
+        the available memory (see :attr:`child_memory`), and the address
+        space of each spatch process is limited to its share of the
+        available memory. When spatch runs out of memory, the level is
+        halved and the batch is run again.
+
+        :param ncpus: number of process to launch in parallel or 'auto'
+        :type ncpus: int or str
         """
-        if have_multiprocessing:
-            self.ncpus = ncpus
-            return True
-        return False
+        self.memory_budget = 0
+        if ncpus == 'auto':
+            (ncpus, self.memory_budget) = _auto_concurrency(
+                self.child_memory)
+            if self.verbose:
+                stderr.write("Running at most %d spatch processes.\n"
+                    % ncpus)
+        self.ncpus = ncpus
+        return True
+
+    def set_sharding(self, sharding):
+        """
+        Set the strategy used to split files in batches
+
+        With the size strategy, the sorted list of files is split in
+        batches of contiguous files. With the include strategy, files are
+        grouped by directory and by included headers (following the
+        includes with quotes) so a header is parsed by as few spatch
+        commands as possible. Every batch gets -I options for the
+        directories of its files and of their headers.
+
+        :param sharding: 'size' or 'include'
+        :type sharding: str
+        :raise: :class:`CocciConfigException`
+        """
+        if sharding not in CocciGrep.sharding_strategies:
+            raise CocciConfigException("Unknown sharding strategy '%s'"
+                % (sharding))
+        self.sharding = sharding
+
+    def _include_dirs(self):
+        include_dirs = []
+        for (i, option) in enumerate(self.options[:-1]):
+            if option == "-I":
+                include_dirs.append(self.options[i + 1])
+        return include_dirs
+
+    def set_batch_size(self, batch_size):
+        """
+        Set size of batches of files given to a spatch command
+
+        This is only used when concurrency is activated. A value of 0
+        will compute a batch size from the total size of the files.
+
+        :param batch_size: size of a batch in bytes
+        :type batch_size: int
+        """
+        self.batch_size = batch_size
+
+    def set_line_cache_size(self, size):
+        """
+        Set maximum size of the cache of source lines used by display
+
+        :param size: size of the cache in bytes
+        :type size: int
+        """
+        self.line_cache = CocciLineCache(size)
 
     def add_options(self, olist):
         """
@@ -381,6 +2460,7 @@ for p in p1:
         :type cmd: str
         """
         self.spatch = cmd
+        self.spatch_version = None
 
     def get_datadir(self):
         this_dir, this_filename = path.split(__file__)
@@ -399,7 +2479,40 @@ for p in p1:
         return _operation_name(fname)
 
     def get_operation_info(self, op):
-        return CocciPatch(self.operations[op])
+        fname = self.operations[op]
+        return CocciPatch(fname, self._operation_headers(fname))
+
+    def _operation_headers(self, fname):
+        """
+        Get the headers of a semantic patch
+
+        Headers are kept in an index stored in the cache directory with
+        the modification time and size of the semantic patches, so a
+        semantic patch is only read again when it changes.
+        """
+        import json
+        index_name = path.join(self.cache_dir or _default_cache_dir(),
+            'operations.json')
+        if self.operation_index is None:
+            try:
+                with open(index_name, 'r') as index_file:
+                    self.operation_index = json.load(index_file)
+            except (IOError, OSError, ValueError):
+                self.operation_index = {}
+        fstat = stat(fname)
+        fid = [fstat.st_mtime, fstat.st_size]
+        key = path.abspath(fname)
+        entry = self.operation_index.get(key)
+        if entry is not None and entry.get('id') == fid:
+            return [tuple(header) for header in entry['headers']]
+        headers = CocciPatch.read_headers(fname)
+        self.operation_index[key] = {'id': fid, 'headers': headers}
+        try:
+            _write_atomic(index_name,
+                json.dumps(self.operation_index).encode('utf8'))
+        except (IOError, OSError):
+            pass
+        return headers
 
     def add_operations(self, new_ops):
         """
@@ -417,13 +2530,372 @@ for p in p1:
                 op = _operation_name(fname)
                 self.operations[op] = fname
 
+    def set_cache_dir(self, cache_dir):
+        """
+        Set directory where cached data is stored
+
+        It holds the rendered semantic patches, the versions of spatch,
+        the index of the operations and the cache of matches (if it is
+        activated with :func:`set_cache`). It defaults to coccigrep in
+        the XDG cache directory.
+
+        :param cache_dir: directory where cache is stored
+        :type cache_dir: str
+        """
+        self.cache_dir = cache_dir
+
+    def set_cache(self, cache_dir=None):
+        """
+        Activate persistent cache of matches
+
+        Files that did not change since a previous run of the same
+        request are not given to spatch: their matches are read from
+        the cache.
+
+        :param cache_dir: directory where cache is stored (see
+                          :func:`set_cache_dir`)
+        :type cache_dir: str
+        """
+        if cache_dir is not None:
+            self.set_cache_dir(cache_dir)
+        self.match_cache = True
+
+    def set_prefilter(self, prefilter=True):
+        """
+        Activate lexical pre-filtering of files
+
+        Before running spatch, files are scanned for the identifiers
+        required by the search and files not containing them are not
+        given to spatch. The identifiers are given by the Prefilter
+        header of the semantic patch which lists the arguments (type,
+        attribute) whose value must appear as is in a matching file.
+        Files are never filtered for an operation without such header.
+
+        :param prefilter: True to activate pre-filtering
+        :type prefilter: bool
+        """
+        self.prefilter = prefilter
+
+    def _prefilter_identifiers(self, operation, stype, attribute):
+        try:
+            variables = self.get_operation_info(operation)["Prefilter"]
+        except KeyError:
+            return []
+        values = {'type': stype, 'attribute': attribute}
+        identifiers = []
+        for variable in variables.split(","):
+            value = values.get(variable.strip())
+            # only plain identifiers can be searched, not types like
+            # 'struct foo' or regular expressions
+            if value and re.match(r"^[A-Za-z_]\w*$", value):
+                ident = value.encode('utf8')
+                identifiers.append((ident, re.compile(
+                    b"(?<![A-Za-z0-9_])" + ident + b"(?![A-Za-z0-9_])")))
+        return identifiers
+
+    def _prefilter_requirements(self):
+        if len(self.queries):
+            queries = self.queries
+        else:
+            queries = [CocciQuery(self.operation, self.type, self.attribute)]
+        requirements = []
+        for query in queries:
+            identifiers = self._prefilter_identifiers(query.operation,
+                query.type, query.attribute)
+            if len(identifiers) == 0:
+                # query can match anywhere
+                return None
+            requirements.append(identifiers)
+        return requirements
+
+    def get_required_identifiers(self):
+        """
+        Get identifiers that must appear in a file for it to match
+
+        :return: a list containing for each query the list of identifiers
+                 required by the query, or None if a file can match
+                 without containing any specific identifier
+        """
+        requirements = self._prefilter_requirements()
+        if requirements is None:
+            return None
+        return [[ident.decode('utf8') for (ident, ident_regexp) in identifiers]
+            for identifiers in requirements]
+
+    def prefilter_files(self, files):
+        """
+        Get the files that may match the current request
+
+        :param files: list of filenames
+        :type files: list of str
+        :return: list of filenames containing all the identifiers needed
+                 by at least one of the queries
+        """
+        requirements = self._prefilter_requirements()
+        if requirements is None:
+            return files
+
+        def may_match(fname):
+            for identifiers in requirements:
+                if _file_contains(fname, identifiers):
+                    return True
+            return False
+
+        if _import_futures():
+            with ThreadPoolExecutor(max_workers=max(4, self.ncpus)) as executor:
+                keep = list(executor.map(may_match, files))
+        else:
+            keep = [may_match(fname) for fname in files]
+        return [fname for (fname, kept) in zip(files, keep) if kept]
+
+    def find_files(self, paths, use_index=True, since=None):
+        """
+        Get the list of source files to search in
+
+        Directories are walked recursively (see :class:`CocciFileFinder`)
+        unless they contain an index (see :class:`CocciIndex`). In this
+        case, the index is updated with the changes of the directory and
+        only the files of the index that may match the current request
+        are returned.
+
+        :param paths: list of filenames and directory names
+        :type paths: list of str
+        :param use_index: use index of directories if available
+        :type use_index: bool
+        :param since: git revision, if set only the files changed since
+                      this revision are returned (see :func:`changed_files`)
+        :type since: str
+        :return: sorted list of filenames
+        :raise: :class:`CocciRunException`
+        """
+        finder = self._file_finder()
+        files = set()
+        for arg in paths:
+            if path.isfile(arg):
+                if finder.is_source(arg):
+                    files.add(arg)
+            elif path.isdir(arg):
+                index = None
+                if use_index and CocciIndex.exists(arg):
+                    index = self._refresh_index(arg, finder)
+                if index is None:
+                    files.update(finder.find(arg))
+                    continue
+                # only take the files that can match from index
+                for fname in index.candidates(self.get_required_identifiers()):
+                    if finder.is_source(fname) and path.isfile(fname):
+                        files.add(fname)
+                index.close()
+            else:
+                raise CocciRunException("'%s' is neither a file or a "
+                    "directory cannot continue." % arg)
+        if since is not None:
+            return self.changed_files(sorted(files), since, paths)
+        return sorted(files)
+
+    def _refresh_index(self, directory, finder):
+        """
+        Open the index of a directory and update it with the changes of
+        the directory
+
+        :return: a :class:`CocciIndex` or None if the index can't be used
+        """
+        if not _import_sqlite():
+            stderr.write("Warning: sqlite3 module is needed to use the index "
+                "of '%s', walking it.\n" % directory)
+            return None
+        index = None
+        try:
+            index = CocciIndex(directory)
+            updated = index.refresh(finder)
+        except sqlite3.Error as err:
+            stderr.write("Warning: unable to update index of '%s' (%s), "
+                "walking it.\n" % (directory, err))
+            if index is not None:
+                index.close()
+            return None
+        if self.verbose and updated:
+            stderr.write("Updated %d files of index of '%s'.\n"
+                % (updated, directory))
+        return index
+
+    def _file_finder(self):
+        return CocciFileFinder(cpp="-c++" in self.options,
+            excludes=self.excludes, use_git=self.use_git)
+
+    def build_index(self, directory):
+        """
+        Build or update the index of a directory (see :class:`CocciIndex`)
+
+        The directory is walked with the same rules as :func:`find_files`.
+
+        :param directory: name of the directory
+        :type directory: str
+        :return: (number of files (re)indexed, number of indexed files)
+        :raise: :class:`CocciRunException` or :class:`CocciConfigException`
+        """
+        if not path.isdir(directory):
+            raise CocciRunException("'%s' is not a directory." % directory)
+        index = CocciIndex(directory)
+        try:
+            updated = index.build(self._file_finder())
+            return (updated, len(index.files()))
+        finally:
+            index.close()
+
+    def changed_files(self, files, since, paths=None):
+        """
+        Get the files changed since a git revision
+
+        Files modified since the revision (committed or not) and untracked
+        files are kept, and so are the files including a changed header
+        directly or not (see :class:`CocciIncludeGraph`).
+
+        :param files: list of filenames
+        :type files: list of str
+        :param since: git revision
+        :type since: str
+        :param paths: files or directories used to find the git checkouts
+                      (directories of the files by default)
+        :type paths: list of str
+        :return: list of the kept filenames
+        :raise: :class:`CocciRunException`
+        """
+        if paths is None:
+            paths = files
+        changed = set()
+        checkouts = set()
+        for arg in paths:
+            directory = arg
+            if not path.isdir(arg):
+                directory = path.dirname(arg) or '.'
+            top = _git_output(directory, ['rev-parse', '--show-toplevel'])
+            checkouts.add(top.rstrip("\n"))
+        for top in checkouts:
+            changed.update(_git_changed_files(top, since))
+        if self.verbose:
+            stderr.write("%d files changed since %s.\n" % (len(changed), since))
+
+        realpaths = {}
+
+        def realname(fname):
+            if fname not in realpaths:
+                realpaths[fname] = path.realpath(fname)
+            return realpaths[fname]
+
+        kept = set(fname for fname in files if realname(fname) in changed)
+        headers = set(fname for fname in changed
+            if not fname.endswith((".c", ".cpp")))
+        others = [fname for fname in files if fname not in kept]
+        if len(headers) and len(others):
+            graph = CocciIncludeGraph(self._include_dirs(), max(4, self.ncpus))
+            for (fname, closure) in graph.closures(others).items():
+                for header in closure:
+                    if realname(header) in headers:
+                        kept.add(fname)
+                        break
+        return [fname for fname in files if fname in kept]
+
+    def add_excludes(self, patterns):
+        """
+        Add patterns of files and directories to skip when walking
+        directories
+
+        :param patterns: list of glob patterns
+        :type patterns: list of str
+        """
+        self.excludes = self.excludes + patterns
+
+    def set_use_git(self, use_git):
+        """
+        Set if git is used to list files and to ignore files
+
+        :param use_git: False to walk all files of directories
+        :type use_git: bool
+        """
+        self.use_git = use_git
+
+    def set_timeout(self, timeout):
+        """
+        Set maximum running time of a spatch command
+
+        When spatch is killed because of the timeout (or crashes), the
+        files it was running on are split in two batches and spatch is
+        run again on each of them until the guilty file is found. This
+        file is reported and skipped (see :func:`set_skip_list`) and
+        the results of the other files are kept.
+
+        :param timeout: timeout in seconds (0 for no timeout)
+        :type timeout: int
+        """
+        self.timeout = timeout
+
+    def set_max_count(self, count):
+        """
+        Set maximum number of matches of a search
+
+        Once this number of matches is found, no more spatch command is
+        started and the running ones are killed. With a concurrency level
+        greater than 1, the matches are the first ones in the order of
+        the files.
+
+        :param count: maximum number of matches (0 for no limit)
+        :type count: int
+        """
+        self.max_count = max(0, count)
+
+    def set_skip_list(self, fname):
+        """
+        Set file containing the list of files to skip
+
+        The file contains one filename per line. Files on which spatch
+        fails are added to it.
+
+        :param fname: name of the skip list file
+        :type fname: str
+        """
+        self.skip_list_file = fname
+        self.skip_list = set()
+        try:
+            with open(fname, 'r') as skip_file:
+                for line in skip_file:
+                    if line.strip():
+                        self.skip_list.add(line.strip())
+        except (IOError, OSError):
+            pass
+
+    def set_stats(self, stats=True):
+        """
+        Activate collection of statistics about the runs
+
+        Statistics of the last run are available via :func:`get_stats`.
+
+        :param stats: True to collect statistics
+        :type stats: bool
+        """
+        if stats:
+            self.stats = CocciStats()
+        else:
+            self.stats = None
+
+    def get_stats(self):
+        """
+        Get statistics about the last run
+
+        :return: a dict (see :func:`CocciStats.to_dict`) or None if
+                 statistics are not activated
+        """
+        if self.stats is None:
+            return None
+        return self.stats.to_dict()
+
     def set_verbose(self):
         """
         Activate verbose mode
         """
         self.verbose = True
 
-    def get_spatch_version(self):
+    def _run_spatch_version(self):
         cmd = [self.spatch] + ['-version']
         try:
             output = Popen(cmd, stdout=PIPE, stderr=STDOUT).communicate()[0]
@@ -433,10 +2905,137 @@ for p in p1:
         m = re.search(reg, output.decode('utf8'))
         return m.group(1)
 
+    def get_spatch_version(self):
+        """
+        Get version of spatch
+
+        The version is only asked to spatch the first time a given spatch
+        binary is used: it is then stored in the cache directory with the
+        modification time of the binary.
+
+        :return: version of spatch as a str
+        """
+        if self.spatch_version is not None:
+            return self.spatch_version
+        spatch_path = _find_executable(self.spatch)
+        if spatch_path is None:
+            # let spatch run report the error
+            return self._run_spatch_version()
+        import json
+        cache_name = path.join(self.cache_dir or _default_cache_dir(),
+            'spatch.json')
+        try:
+            with open(cache_name, 'r') as cache_file:
+                versions = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            versions = {}
+        mtime = stat(spatch_path).st_mtime
+        entry = versions.get(spatch_path)
+        if entry is not None and entry.get('mtime') == mtime:
+            self.spatch_version = entry['version']
+            return self.spatch_version
+        self.spatch_version = self._run_spatch_version()
+        versions[spatch_path] = {'mtime': mtime, 'version': self.spatch_version}
+        try:
+            _write_atomic(cache_name, json.dumps(versions).encode('utf8'))
+        except (IOError, OSError):
+            pass
+        return self.spatch_version
+
     def spatch_newer_than(self, version):
-        from distutils.version import LooseVersion
         sversion = self.get_spatch_version()
-        return LooseVersion(sversion) > LooseVersion(version)
+        return _version_key(sversion) > _version_key(version)
+
+    def _template(self, operation):
+        """
+        Get the content of the semantic patch of an operation
+
+        Content is kept in memory as long as the file is unchanged.
+        """
+        if operation not in self.operations:
+            raise CocciRunException("Unknown operation '%s'." % operation)
+        fname = self.operations[operation]
+        fstat = stat(fname)
+        entry = self.templates.get(fname)
+        if entry is None or entry[0] != (fstat.st_mtime, fstat.st_size):
+            with open(fname, 'r') as cocci_file:
+                entry = ((fstat.st_mtime, fstat.st_size), cocci_file.read())
+            self.templates[fname] = entry
+        return entry[1]
+
+    def _render_template(self, operation, stype, attribute, cocci_op):
+        cocci_smpl_tmpl = Template(self._template(operation))
+        # do substitution
+        return cocci_smpl_tmpl.substitute(type=stype,
+            attribute=attribute, cocci_regexp_equal=cocci_op)
+
+    def _cocci_op(self):
+        # get version of spatch
+        if self.spatch_newer_than("1.0.0-rc6"):
+            return "=~"
+        return "~="
+
+    def _patch_key(self, queries=None):
+        """
+        Get the hash identifying the semantic patch of the current request
+
+        It is computed from the content of the semantic patches of the
+        operations, the substituted values and the regexp syntax of
+        spatch so it changes whenever the rendered patch would.
+
+        :param queries: queries to use instead of the ones of the setup
+        """
+        items = [COCCIGREP_VERSION, self._cocci_op()]
+        if queries is None:
+            queries = self.queries
+        if len(queries):
+            items.append('batch')
+        else:
+            items.append('single')
+            queries = [CocciQuery(self.operation, self.type, self.attribute)]
+        for query in queries:
+            items += [self._template(query.operation), str(query.type),
+                str(query.attribute)]
+        return _hash(*items)
+
+    def _render_cocci(self, queries=None):
+        """
+        Build semantic patch for the current request
+
+        :param queries: queries to use instead of the ones of the setup
+        :return: content of the semantic patch as a str
+        """
+        cocci_op = self._cocci_op()
+        if queries is None:
+            queries = self.queries
+        if len(queries):
+            return self._render_batch(cocci_op, queries)
+        cocci_smpl = self._render_template(self.operation, self.type,
+            self.attribute, cocci_op)
+        if '@filter@' in cocci_smpl:
+            return cocci_smpl + CocciGrep.cocci_python_hdr_filter + CocciGrep.cocci_python
+        return cocci_smpl + CocciGrep.cocci_python_hdr_std + CocciGrep.cocci_python
+
+    def _render_batch(self, cocci_op, queries):
+        """
+        Build semantic patch merging all the queries
+
+        Rules of query N are suffixed by _qN and the matches are printed
+        with a qN prefix.
+        """
+        cocci_grep = ""
+        for (index, query) in enumerate(queries):
+            tag = "q%d" % index
+            cocci_smpl = self._render_template(query.operation, query.type,
+                query.attribute, cocci_op)
+            dependency = ""
+            if '@filter@' in cocci_smpl:
+                dependency = "depends on filter_%s " % tag
+            cocci_grep += _rename_rules(cocci_smpl, "_" + tag) + \
+                CocciGrep.cocci_python_hdr_tagged.substitute(
+                    dependency=dependency) + \
+                CocciGrep.cocci_python_tagged.substitute(tag=tag) + "\n"
+        return cocci_grep
 
     def run(self, files):
         """
@@ -445,116 +3044,483 @@ for p in p1:
         This function is doing the main job. It will run spatch with
         the correct parameters by using subprocess or it will use
         multiprocessing if a concurrency level greater than 1 has been
-        asked.
+        asked. Matches are stored in the matches attribute (a
+        :class:`CocciMatchSet`).
 
         :param args: list of filenames and directory names
         :type args: list of str
         :raise: :class:`CocciRunException` or :class:`CocciConfigException`
         """
+        self.matches = CocciMatchSet(self, self.iter_matches(files))
+
+    def search(self, query, files):
+        """
+        Run a search asynchronously (python 3.6 and later)
+
+        Unlike :func:`run`, the search does not use the setup of the
+        instance and does not store its matches in it, so a single
+        instance can be used by concurrent searches. See
+        :mod:`coccigrep.aio` for details::
+
+            async with grep.search(query, files) as matches:
+                async for match in matches:
+                    ...
+
+        :param query: query or list of queries searched in a single run
+        :type query: :class:`CocciQuery` or list of :class:`CocciQuery`
+        :param files: list of filenames
+        :type files: list of str
+        :return: a :class:`coccigrep.aio.CocciSearch`, async iterator of
+                 :class:`CocciMatch` stopping the search when used as an
+                 async context manager
+        :raise: :class:`CocciConfigException` with python older than 3.6
+        """
+        if sys.version_info < (3, 6):
+            raise CocciConfigException("Asynchronous search needs python "
+                "3.6 or later")
+        from .aio import search
+        return search(self, query, files)
+
+    def iter_matches(self, files):
+        """
+        Run the search and yield matches as soon as spatch outputs them
+
+        The search is stopped once the maximum number of matches is
+        found (see :func:`set_max_count`).
 
+        :param files: list of filenames
+        :type files: list of str
+        :return: a generator of :class:`CocciMatch`
+        :raise: :class:`CocciRunException` or :class:`CocciConfigException`
+        """
         if len(files) == 0:
             raise CocciRunException("Can't use coccigrep without files "
                 "to search")
 
-        # get version of spatch
-        if self.spatch_newer_than("1.0.0-rc6"):
-            cocci_op = "=~"
-        else:
-            cocci_op = "~="
-        # create tmp cocci file:
-        tmp_cocci_file = NamedTemporaryFile(suffix=".cocci", delete=not self.verbose)
-        tmp_cocci_file_name = tmp_cocci_file.name
-        # open file with name matching operation
-        cocci_file = open(self.operations[self.operation], 'r')
-        # get the string and build template
-        cocci_tmpl = cocci_file.read()
-        cocci_smpl_tmpl = Template(cocci_tmpl)
-        cocci_file.close()
-        # do substitution
-        cocci_smpl = cocci_smpl_tmpl.substitute(type=self.type,
-            attribute=self.attribute, cocci_regexp_equal=cocci_op)
-        if '@filter@' in cocci_smpl:
-            cocci_grep = cocci_smpl + CocciGrep.cocci_python_hdr_filter + CocciGrep.cocci_python
-        else:
-            cocci_grep = cocci_smpl + CocciGrep.cocci_python_hdr_std + CocciGrep.cocci_python
+        if self.stats is not None:
+            self.stats = CocciStats()
+            self.stats.files = len(files)
+            start = time()
+        patch_key = self._patch_key()
+        patches = CocciPatchCache(self.cache_dir or _default_cache_dir())
+        sp_file = patches.lookup(patch_key)
+        tmp_cocci_file = None
+        if sp_file is None:
+            cocci_grep = self._render_cocci()
+            sp_file = patches.store(patch_key, cocci_grep)
+            if sp_file is None:
+                # store is not writable, use a temporary file
+                from tempfile import NamedTemporaryFile
+                tmp_cocci_file = NamedTemporaryFile(suffix=".cocci",
+                    delete=not self.verbose)
+                if sys.version < '3':
+                    tmp_cocci_file.write(cocci_grep)
+                else:
+                    tmp_cocci_file.write(bytes(cocci_grep, 'UTF-8'))
+                tmp_cocci_file.flush()
+                sp_file = tmp_cocci_file.name
+        if self.stats is not None:
+            self.stats.render_time = time() - start
 
-        if sys.version < '3':
-            tmp_cocci_file.write(cocci_grep)
-        else:
-            tmp_cocci_file.write(bytes(cocci_grep, 'UTF-8'))
-        tmp_cocci_file.flush()
-
-        # launch spatch
-        output = "".encode('utf8')
-        # Launch parallel spatch
-        if self.ncpus > 1 and len(files) > 1:
-            fseq = []
-            splitsize = 1.0 / self.ncpus * len(files)
-            for i in range(self.ncpus):
-                start = int(round(i * splitsize))
-                end = int(round((i + 1) * splitsize))
-                rfiles = files[start:end]
-                if len(rfiles) >= 1:
-                    fseq.append(rfiles)
-            for sub_files in fseq:
-                cmd = [self.spatch]
-                cmd += self.options
-                cmd += ["-sp_file", tmp_cocci_file.name]
-                for cfile in sub_files:
-                    include_dir = path.dirname(cfile)
-                    if len(include_dir):
-                        cmd += ["-I", include_dir]
-                        break
-                cmd += sub_files
-                sprocess = CocciProcess(cmd, self.verbose)
-                sprocess.start()
-                self.process.append(sprocess)
-            for process in self.process:
-                ret = process.recv().decode('utf8')
-                process.join()
-                if not ret.startswith('cexceptions\n'):
-                    # CocciProcess return a serialized exception
-                    # in case of exception
-                    output += ret.encode('utf8')
-                    continue
-                import json
-                err = json.loads(ret)
-                _raise_run_err(err, cmd)
-            tmp_cocci_file.close()
-        # Fallback to one spatch
-        else:
+        lines = None
+        try:
+            # get cached results
+            cache = None
+            cached = {}
+            run_files = files
+            if self.match_cache:
+                cache = CocciMatchCache(self.cache_dir or _default_cache_dir(),
+                    _hash(patch_key, self.get_spatch_version(), *self.options))
+                run_files = []
+                for fname in files:
+                    entry = cache.lookup(fname)
+                    if entry is None:
+                        run_files.append(fname)
+                    else:
+                        cached[fname] = entry
+                # entries are validated against the included headers
+                graph = CocciIncludeGraph(self._include_dirs(),
+                    max(4, self.ncpus))
+                closures = graph.closures(run_files)
+
+            if self.prefilter and len(run_files):
+                candidates = self.prefilter_files(run_files)
+                if self.verbose:
+                    stderr.write("Pre-filter kept %d files out of %d.\n"
+                        % (len(candidates), len(run_files)))
+                if cache is not None:
+                    # files without the identifiers can't have matches
+                    kept = set(candidates)
+                    for fname in run_files:
+                        if fname not in kept:
+                            cached[fname] = ([], [])
+                            cache.store(fname, [], deps=closures[fname])
+                run_files = candidates
+
+            if len(self.skip_list):
+                run_files = [fname for fname in run_files
+                    if path.abspath(fname) not in self.skip_list]
+            self.quarantined = []
+            if self.stats is not None:
+                self.stats.spatch_files = len(run_files)
+            # launch spatch
             cmd = [self.spatch]
             cmd += self.options
-            cmd += ["-sp_file", tmp_cocci_file.name]
-            cmd += files
-            include_dir = path.dirname(files[0])
-            if len(include_dir):
-                cmd += ["-I", include_dir]
-            try:
-                if self.verbose:
-                    stderr.write("Running: %s.\n" % " ".join(cmd))
-                    output = Popen(cmd, stdout=PIPE).communicate()[0]
-                else:
-                    output = Popen(cmd, stdout=PIPE, stderr=PIPE).communicate()[0]
-            except OSError as err:
-                unlink(tmp_cocci_file_name)
-                _raise_run_err(err, cmd)
+            cmd += ["-sp_file", sp_file]
+            if len(run_files) == 0:
+                lines = (line for line in ())
+            elif self.ncpus > 1 and len(run_files) > 1:
+                lines = self._iter_parallel(run_files, cmd)
+            else:
+                lines = self._iter_serial(run_files, cmd)
+
+            matches = self._parse_output(lines)
+            if cache is not None:
+                matches = self._iter_cached(matches, cache, files, run_files,
+                    cached, closures)
+            count = 0
+            for match in matches:
+                count += 1
+                if count == self.max_count:
+                    # stop spatch before handing the last match
+                    lines.close()
+                    yield match
+                    break
+                yield match
+        finally:
+            if lines is not None:
+                lines.close()
+            if tmp_cocci_file is not None:
+                tmp_cocci_file.close()
+            if self.stats is not None:
+                self.stats.wall = time() - start
+
+    def _batch_done(self, files, result, pool=None):
+        """
+        Handle the end of the spatch run on a batch of files
 
-            tmp_cocci_file.close()
+        :param pool: pool running the batch, shrunk if spatch ran out of
+                     memory with the automatic concurrency level
+        :return: list of batches to run again if spatch has been killed
+                 (by the timeout, by a crash or by lack of memory), an
+                 empty list otherwise
+        """
+        if self.stats is not None:
+            self.stats.add_worker(result)
+        if result.get('memory') and self.memory_budget and \
+                pool is not None and pool.size > 1:
+            size = pool.shrink()
+            if self.verbose:
+                stderr.write("spatch ran out of memory, running at most "
+                    "%d spatch processes.\n" % size)
+            return [files]
+        if not result['timeout'] and result['returncode'] >= 0 and \
+                not result.get('memory'):
+            return []
+        if len(files) > 1:
+            # bisect to find the guilty file
+            if self.verbose:
+                stderr.write("spatch failed on a batch of %d files, "
+                    "splitting it.\n" % len(files))
+            middle = len(files) // 2
+            return [files[:middle], files[middle:]]
+        self._quarantine(files[0], result)
+        return []
+
+    def _quarantine(self, fname, result):
+        """
+        Report and skip a file on which spatch failed
 
-        self.matches = []
-        for ematch in output.decode('utf8').split("\n"):
+        The file is added to the skip list file unless spatch ran out of
+        memory: it may succeed with more memory.
+        """
+        if result['timeout']:
+            reason = "timeout after %d seconds" % self.timeout
+        elif result.get('memory'):
+            reason = "out of memory"
+        else:
+            reason = "killed by signal %d" % -result['returncode']
+        stderr.write("Warning: spatch failed on '%s' (%s), skipping it.\n"
+            % (fname, reason))
+        self.quarantined.append(fname)
+        if self.stats is not None:
+            self.stats.quarantined.append({'file': fname, 'reason': reason})
+        if self.skip_list_file is not None and not result.get('memory'):
             try:
-                (efile, eline, ecol, elinend, ecolend) = ematch.split(":")
-                nmatch = CocciMatch(efile, eline, ecol, elinend, ecolend, self)
-                self.matches.append(nmatch)
-            except ValueError:
-                pass
+                with open(self.skip_list_file, 'a') as skip_file:
+                    skip_file.write(path.abspath(fname) + "\n")
+            except (IOError, OSError) as err:
+                stderr.write("Warning: unable to update skip list: %s\n"
+                    % err)
 
-    def display(self, mode='raw', before=0, after=0, oformat='term'):
+    def _iter_serial(self, files, cmd):
         """
-        Display output for complete request
+        Run spatch on all files in a single process
+
+        If spatch is killed, the files are split in two batches which are
+        run one after the other until the guilty file is found. Lines
+        already yielded by a killed run are not yielded again.
+        """
+        batches = [files]
+        suppressed = set()
+        while len(batches):
+            sub_files = batches.pop(0)
+            bcmd = cmd + sub_files + _include_options(sub_files)
+            result = {}
+            if self.stats is not None:
+                result = _batch_record(sub_files)
+            yielded = []
+            try:
+                for line in _spatch_lines(bcmd, self.verbose, result,
+                        self.stats is not None, self.timeout,
+                        self.memory_budget):
+                    if line in suppressed:
+                        continue
+                    yielded.append(line)
+                    yield line
+            except OSError as err:
+                _raise_run_err(err, bcmd)
+            retry = self._batch_done(sub_files, result)
+            if len(retry):
+                suppressed.update(yielded)
+                batches = retry + batches
+
+    def _parse_output(self, lines):
+        stats = self.stats
+        for line in lines:
+            if stats is not None:
+                start = time()
+            match = _parse_match(line, self, self.queries)
+            if match is None:
+                continue
+            if stats is not None:
+                stats.parse_time += time() - start
+                stats.matches += 1
+            yield match
+
+    def _iter_parallel(self, files, cmd):
+        """
+        Run spatch on files with a pool of spatch processes
+
+        Files are split in batches which are queued in a
+        :class:`CocciPool`. A new spatch process is started on the next
+        batch as soon as one ends, so a slow batch does not keep the
+        other slots idle. A batch on which spatch is killed is split in
+        two new batches.
+
+        With the include sharding strategy (see :func:`set_sharding`),
+        files sharing their headers are put in the same batch.
+
+        Output of a finished batch is sorted by (file, line, column) and
+        the sorted outputs are merged: a line is yielded as soon as no
+        unfinished batch can output a smaller one, so output is sorted
+        and does not depend on the timing of the workers. Matches in a
+        searched file are only taken from the batch searching it, so
+        matches in headers found by other batches are dropped. Matches
+        in files which are not searched (headers reached through
+        includes) are yielded sorted at the end.
+        """
+        batch_size = self.batch_size
+        if batch_size <= 0:
+            # aim at a few batches per worker
+            total_size = 0
+            for fname in files:
+                try:
+                    total_size += stat(fname).st_size
+                except OSError:
+                    pass
+            batch_size = max(1, total_size // (self.ncpus * 4))
+        if self.sharding == 'include':
+            graph = CocciIncludeGraph(self._include_dirs(), max(4, self.ncpus))
+            shards = _make_include_batches(files, batch_size, graph)
+        else:
+            shards = [(sub_files, ())
+                      for sub_files in _make_batches(files, batch_size)]
+        pool = CocciPool(cmd, self.ncpus, self.verbose, self.stats is not None,
+            self.timeout, self.memory_budget, self.child_memory)
+        # batches are identified by a tuple so the two halves of a batch
+        # get new identifiers
+        batches = {}
+        headers = {}
+        owner = {}
+        outputs = {}
+        for (index, (sub_files, sub_headers)) in enumerate(shards):
+            bid = (index, )
+            batches[bid] = sub_files
+            headers[bid] = sub_headers
+            outputs[bid] = []
+            for fname in sub_files:
+                owner[fname] = bid
+            pool.submit(bid, sub_files, _include_options(sub_files, sub_headers))
+        # smallest file of each unfinished batch
+        lower = dict((bid, min(sub_files)) for (bid, sub_files) in batches.items())
+        # heap of (key, line, batch, position) on sorted batch outputs
+        merge = []
+        sorted_outputs = {}
+        foreign = []
+        last_key = None
+        tagged = len(self.queries) > 0
+        try:
+            for (bid, line, result) in pool.events():
+                if line is not None:
+                    key = _output_key(line, tagged)
+                    if key is None:
+                        continue
+                    fowner = owner.get(key[0])
+                    if fowner is None:
+                        foreign.append((key, line))
+                    elif fowner == bid:
+                        outputs[bid].append((key, line))
+                    continue
+                if self.stats is not None:
+                    result['batch'] = list(bid)
+                sub_files = batches.pop(bid)
+                del lower[bid]
+                output = outputs.pop(bid)
+                retry = self._batch_done(sub_files, result, pool)
+                if len(retry):
+                    sub_headers = headers.pop(bid)
+                    for (i, retry_files) in enumerate(retry):
+                        rbid = bid + (i, )
+                        batches[rbid] = retry_files
+                        headers[rbid] = sub_headers
+                        outputs[rbid] = []
+                        lower[rbid] = min(retry_files)
+                        for fname in retry_files:
+                            owner[fname] = rbid
+                        pool.submit(rbid, retry_files,
+                            _include_options(retry_files, sub_headers))
+                    continue
+                headers.pop(bid)
+                if len(output):
+                    output.sort()
+                    sorted_outputs[bid] = output
+                    heapq.heappush(merge, (output[0][0], output[0][1], bid, 0))
+                watermark = None
+                if len(lower):
+                    watermark = min(lower.values())
+                while len(merge) and (watermark is None or
+                                      merge[0][0][0] < watermark):
+                    (key, line, mbid, position) = heapq.heappop(merge)
+                    if key != last_key:
+                        yield line
+                    last_key = key
+                    output = sorted_outputs[mbid]
+                    position += 1
+                    if position < len(output):
+                        heapq.heappush(merge, (output[position][0],
+                            output[position][1], mbid, position))
+                    else:
+                        del sorted_outputs[mbid]
+        finally:
+            pool.close()
+        last_key = None
+        for (key, line) in sorted(foreign):
+            if key != last_key:
+                yield line
+            last_key = key
+
+    def _iter_cached(self, matches, cache, files, run_files, cached,
+                     closures):
+        """
+        Add cached matches to the stream of matches and update cache
+
+        Cached matches of a file are yielded before the first match of
+        a file coming after it in the list of files. Matches in files
+        which are not searched (headers reached through includes) are
+        stored with the files including them and are yielded sorted at
+        the end, so output does not depend on what is cached. Matches in
+        headers which are not found by :class:`CocciIncludeGraph` (system
+        includes) can't be stored. Names of these files are normalized so
+        live and cached matches get the same name.
+        """
+        order = dict((fname, index) for (index, fname) in enumerate(files))
+        normalized = dict((path.normpath(fname), fname) for fname in files)
+        cached_files = [fname for fname in files if fname in cached]
+        cached_index = 0
+        found = {}
+        including = {}
+        for fname in run_files:
+            for header in closures.get(fname, ()):
+                including.setdefault(path.realpath(header), []).append(fname)
+        found_foreign = {}
+        foreign = {}
+        for match in matches:
+            position = [match.line, match.column, match.lineend,
+                match.columnend]
+            if match.query is not None:
+                position.append(self.queries.index(match.query))
+            findex = order.get(match.file)
+            if findex is None:
+                match.file = path.normpath(match.file)
+                if match.file in normalized:
+                    match.file = normalized[match.file]
+                    findex = order[match.file]
+            if findex is None:
+                foreign[tuple([match.file] + position)] = match
+                for fname in including.get(path.realpath(match.file), []):
+                    rel = match.file
+                    if not path.isabs(rel):
+                        rel = path.relpath(rel, path.dirname(fname) or '.')
+                    found_foreign.setdefault(fname, []).append([rel] + position)
+                continue
+            if match.file in cached:
+                # searched header reached through an include, its matches
+                # come from the cache
+                continue
+            positions = found.setdefault(match.file, [])
+            if position in positions:
+                # searched header also reached through an include
+                continue
+            while (cached_index < len(cached_files) and
+                   order[cached_files[cached_index]] < findex):
+                for cmatch in self._cached_matches(
+                        cached_files[cached_index], cached):
+                    yield cmatch
+                cached_index += 1
+            positions.append(position)
+            yield match
+        for fname in cached_files[cached_index:]:
+            for cmatch in self._cached_matches(fname, cached):
+                yield cmatch
+        for fname in cached_files:
+            for position in cached[fname][1]:
+                hname = path.normpath(path.join(path.dirname(fname),
+                    position[0]))
+                key = tuple([hname] + position[1:])
+                if key not in foreign:
+                    foreign[key] = self._cached_match(hname, position[1:])
+        for key in sorted(foreign):
+            yield foreign[key]
+        # only reached if the search was complete
+        for fname in run_files:
+            if fname not in self.quarantined:
+                cache.store(fname, found.get(fname, []),
+                    found_foreign.get(fname), closures[fname])
+
+    def _cached_match(self, fname, position):
+        query = None
+        if len(position) > 4:
+            query = self.queries[position[4]]
+        (mline, mcol, mlineend, mcolend) = position[:4]
+        return CocciMatch(fname, mline, mcol, mlineend, mcolend, self, query)
+
+    def _cached_matches(self, fname, cached):
+        for position in cached[fname][0]:
+            yield self._cached_match(fname, position)
+
+    def iter_display(self, matches, mode='raw', before=0, after=0,
+                     oformat='term'):
+        """
+        Yield output for each match of a stream of matches
 
+        The output of a match is yielded as soon as the next match is
+        known (or the stream is finished) as it may depend on it for
+        context display. In color mode, output is yielded for groups of
+        matches of the same file and is computed in a pool of processes
+        when there is a lot of matches (and concurrency is activated).
+
+        :param matches: iterable of :class:`CocciMatch`
         :param mode: display mode
         :type mode: str
         :param before: number of lines to display before match
@@ -563,12 +3529,24 @@ for p in p1:
         :type after: int
         :param oformat: format of output for color (term, html)
         :type oformat: str
-        :return: the result of the search as a str
+        :return: a generator of str
         """
-        if before != 0 or after != 0:
-            prev_match = None
-            for index in range(len(self.matches)):
-                cur_match = self.matches[index]
+        if mode == 'json':
+            # one record per match, context has no meaning
+            before = after = 0
+        matches = self._iter_context(matches, before, after)
+        if mode == 'color' and oformat in CocciRenderer.formats and \
+                _import_pygments():
+            for output in self._iter_color(matches, oformat):
+                yield output
+            return
+        for match in matches:
+            yield self._display_match(match, mode, oformat)
+
+    def _iter_context(self, matches, before, after):
+        prev_match = None
+        for cur_match in matches:
+            if before != 0 or after != 0:
                 cur_match.start_at = cur_match.line - before
                 cur_match.stop_at = cur_match.line + after
                 if cur_match.start_at < 1:
@@ -586,9 +3564,261 @@ for p in p1:
                             # No separator if groups are contiguous
                             prev_match.trailer = ""
 
-                prev_match = cur_match
+            if prev_match is not None:
+                yield prev_match
+            prev_match = cur_match
+        if prev_match is not None:
+            yield prev_match
+
+    def _iter_color_jobs(self, matches, oformat):
+        snippets = []
+        prev_file = None
+        for match in matches:
+            if snippets and (match.file != prev_file or
+                             len(snippets) >= self.render_group_size):
+                yield (oformat, snippets)
+                snippets = []
+            stype = self.type
+            if match.query is not None:
+                stype = match.query.label()
+            (text, pmatch) = match.color_text(stype)
+            snippets.append((text, pmatch))
+            prev_file = match.file
+        if snippets:
+            yield (oformat, snippets)
+
+    def _iter_color(self, matches, oformat):
+        renderer = CocciRenderer(oformat)
+        jobs = self._iter_color_jobs(matches, oformat)
+        use_pool = self.ncpus > 1 and _import_multiprocessing()
+        rendered = 0
+        for job in jobs:
+            if rendered == 0 and oformat == 'html':
+                yield renderer.stylesheet()
+            if self.stats is not None:
+                start = time()
+            output = renderer.render(job[1])
+            if self.stats is not None:
+                self.stats.display_time += time() - start
+            yield output
+            rendered += len(job[1])
+            if use_pool and rendered >= self.render_pool_threshold:
+                break
+        else:
+            return
+        # a lot of matches: colorize next groups in a pool, keeping order
+        pool = Pool(self.ncpus)
+        pending = deque()
+        try:
+            for job in jobs:
+                pending.append(pool.apply_async(_render_snippets, (job,)))
+                while pending and (pending[0].ready() or
+                                   len(pending) > 2 * self.ncpus):
+                    yield self._render_result(pending.popleft())
+            while pending:
+                yield self._render_result(pending.popleft())
+        finally:
+            pool.terminate()
+
+    def _render_result(self, result):
+        if self.stats is not None:
+            start = time()
+        output = result.get()
+        if self.stats is not None:
+            self.stats.display_time += time() - start
+        return output
+
+    def _display_match(self, match, mode, oformat):
+        if self.stats is not None:
+            start = time()
+        if match.query is not None:
+            output = match.display(match.query.label(), mode=mode,
+                oformat=oformat)
+        else:
+            output = match.display(self.type, mode=mode, oformat=oformat)
+        if self.stats is not None:
+            self.stats.display_time += time() - start
+        return output
+
+    def display(self, mode='raw', before=0, after=0, oformat='term'):
+        """
+        Display output for complete request
 
-        output = ''.join(match.display(self.type, mode=mode, oformat=oformat)
-            for match in self.matches)
+        :param mode: display mode
+        :type mode: str
+        :param before: number of lines to display before match
+        :type before: int
+        :param after: number of lines to display after match
+        :type after: int
+        :param oformat: format of output for color (term, html)
+        :type oformat: str
+        :return: the result of the search as a str
+        """
+        matches = self.matches
+        if isinstance(matches, CocciMatchSet) and mode != 'json':
+            # context is computed on the columns of the set
+            matches = matches.iter_context(before, after)
+            before = after = 0
+        output = ''.join(self.iter_display(matches, mode=mode,
+            before=before, after=after, oformat=oformat))
 
         return output.rstrip()
+
+
+class CocciServer:
+    """
+    Serve requests on a unix socket with a long lived CocciGrep instance
+
+    Version of spatch, caches and file lists are kept between requests.
+    A request is a JSON object on a single line with the following keys:
+
+     - cwd: directory where the request is run
+     - files: list of filenames and directory names
+     - type, attribute, operation: the search (see :func:`CocciGrep.setup`)
+     - queries: list of [operation, type, attribute], used instead of the
+       search keys for batch mode
+     - sp: absolute filename of a semantic patch used for this request,
+       its name being the operation (see :func:`CocciGrep.add_operations`)
+     - since: git revision, only the files changed since this revision
+       are searched (see :func:`CocciGrep.changed_files`)
+     - display: parameters of :func:`CocciGrep.iter_display`
+     - max_count: maximum number of matches (see
+       :func:`CocciGrep.set_max_count`), the one of the server by default
+
+    The answer is a stream of JSON objects, one per line. Objects with an
+    output key contain the display of a match. The last object contains
+    a status key (0 if something was found, 1 otherwise) or an error key.
+    """
+    # time in seconds during which a directory walk is reused
+    file_list_ttl = 60
+
+    def __init__(self, coccigrep, socket_name):
+        self.coccigrep = coccigrep
+        self.socket_name = socket_name
+        self.file_lists = {}
+        self.max_count = coccigrep.max_count
+
+    def serve_forever(self):
+        try:
+            from socketserver import UnixStreamServer, StreamRequestHandler
+        except ImportError:
+            from SocketServer import UnixStreamServer, StreamRequestHandler
+        server = self
+
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                server.handle(self.rfile, self.wfile)
+
+        import signal
+        # exit cleanly so the socket is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if path.exists(self.socket_name):
+            unlink(self.socket_name)
+        userver = UnixStreamServer(self.socket_name, Handler)
+        try:
+            userver.serve_forever()
+        finally:
+            userver.server_close()
+            unlink(self.socket_name)
+
+    def _find_files(self, paths):
+        key = (getcwd(), tuple(paths))
+        if any(path.isdir(arg) and CocciIndex.exists(arg) for arg in paths):
+            # files taken from an index depend on the request
+            key += (repr(self.coccigrep.get_required_identifiers()), )
+        entry = self.file_lists.get(key)
+        if entry is None or entry[0] + CocciServer.file_list_ttl < time():
+            entry = (time(), self.coccigrep.find_files(paths))
+            self.file_lists[key] = entry
+        return entry[1]
+
+    def handle(self, rfile, wfile):
+        import json
+
+        def send(answer):
+            try:
+                wfile.write((json.dumps(answer) + "\n").encode('utf8'))
+                wfile.flush()
+            except (IOError, OSError):
+                raise _ClientGone()
+
+        try:
+            self._handle(rfile, send)
+        except _ClientGone:
+            # running search has been stopped when leaving the generator
+            pass
+
+    def _handle(self, rfile, send):
+        import json
+        coccigrep = self.coccigrep
+        saved_operation = None
+        try:
+            request = json.loads(rfile.readline().decode('utf8'))
+            chdir(request.get('cwd', '/'))
+            if request.get('sp'):
+                # only used by this request
+                operation = _operation_name(request['sp'])
+                saved_operation = (operation,
+                    coccigrep.operations.get(operation))
+                coccigrep.add_operations([request['sp']])
+            if request.get('queries'):
+                coccigrep.setup_batch([CocciQuery(*query)
+                    for query in request['queries']])
+            else:
+                coccigrep.setup(request.get('type'), request.get('attribute'),
+                    request.get('operation', 'used'))
+            coccigrep.set_max_count(request.get('max_count', self.max_count))
+            # files may have changed since last request
+            coccigrep.line_cache.clear()
+            files = self._find_files(request.get('files', []))
+            if request.get('since'):
+                files = coccigrep.changed_files(files, request['since'],
+                    request.get('files', []))
+                if len(files) == 0:
+                    send({'status': 1})
+                    return
+            found = False
+            for output in coccigrep.iter_display(coccigrep.iter_matches(
+                    files), **request.get('display', {})):
+                found = True
+                send({'output': output})
+            send({'status': 0 if found else 1})
+        except CocciException as err:
+            send({'error': str(err)})
+        except (ValueError, TypeError, KeyError, OSError) as err:
+            send({'error': "Invalid request: %s" % err})
+        finally:
+            if saved_operation is not None:
+                (operation, fname) = saved_operation
+                if fname is None:
+                    del coccigrep.operations[operation]
+                else:
+                    coccigrep.operations[operation] = fname
+
+
+class _ClientGone(Exception):
+    pass
+
+
+def query_server(socket_name, request):
+    """
+    Send a request to a :class:`CocciServer` and yield its answers
+
+    :param socket_name: path of the server socket
+    :type socket_name: str
+    :param request: request as described in :class:`CocciServer`
+    :type request: dict
+    :return: a generator of answers (dict)
+    """
+    import json
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_name)
+        sock.sendall((json.dumps(request) + "\n").encode('utf8'))
+        rfile = sock.makefile('rb')
+        for line in rfile:
+            yield json.loads(line.decode('utf8'))
+        rfile.close()
+    finally:
+        sock.close()
@@ -0,0 +1,111 @@
+# Copyright (C) 2011-2018 Eric Leblond <eric@regit.org>
+#
+# You can copy, redistribute or modify this Program under the terms of
+# the GNU General Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# version 3 along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from bench.run import FAKE_SPATCH, load_coccigrep
+
+coccigrep = load_coccigrep()
+from coccigrep import aio  # noqa: E402
+
+SOURCE = """int f%d(struct foo *p)
+{
+	return p->bar;
+}
+"""
+
+
+def _tasks():
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks()
+    return asyncio.Task.all_tasks()
+
+
+def _has_children():
+    try:
+        return os.waitpid(-1, os.WNOHANG) == (0, 0)
+    except ChildProcessError:
+        return False
+
+
+class SearchTest(unittest.TestCase):
+    nfiles = 16
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = []
+        for index in range(self.nfiles):
+            fname = os.path.join(self.directory, 'f%02d.c' % index)
+            with open(fname, 'w') as f:
+                f.write(SOURCE % index)
+            self.files.append(fname)
+        self.grep = coccigrep.CocciGrep()
+        self.grep.set_spatch_cmd(FAKE_SPATCH)
+        self.grep.cache_dir = os.path.join(self.directory, 'cache')
+        # one file per batch
+        self.grep.set_batch_size(1)
+        self.query = coccigrep.CocciQuery('deref', 'struct foo', 'bar')
+        os.environ['FAKE_SPATCH_LATENCY'] = '0.5'
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        del os.environ['FAKE_SPATCH_LATENCY']
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.directory)
+
+    def assertStopped(self):
+        current = asyncio.current_task() if hasattr(asyncio, 'current_task') \
+            else asyncio.Task.current_task()
+        pending = [task for task in _tasks()
+                   if task is not current and not task.done()]
+        self.assertEqual(pending, [])
+        self.assertFalse(_has_children())
+
+    def test_complete(self):
+        os.environ['FAKE_SPATCH_LATENCY'] = '0'
+
+        async def run():
+            async with self.grep.search(self.query, self.files) as matches:
+                return [match.file async for match in matches]
+        self.assertEqual(self.loop.run_until_complete(run()), self.files)
+
+    def test_break_in_block(self):
+        async def run():
+            async with self.grep.search(self.query, self.files) as matches:
+                async for match in matches:
+                    self.assertEqual(match.file, self.files[0])
+                    break
+            self.assertStopped()
+        self.loop.run_until_complete(run())
+
+    def test_aclose(self):
+        async def run():
+            matches = self.grep.search(self.query, self.files)
+            async for match in matches:
+                break
+            await matches.aclose()
+            self.assertStopped()
+        self.loop.run_until_complete(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
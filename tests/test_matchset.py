@@ -0,0 +1,51 @@
+# Copyright (C) 2011-2018 Eric Leblond <eric@regit.org>
+#
+# You can copy, redistribute or modify this Program under the terms of
+# the GNU General Public License version 3 as published by the Free
+# Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# version 3 along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import unittest
+
+from bench.run import load_coccigrep
+
+coccigrep = load_coccigrep()
+
+
+class MatchSetTest(unittest.TestCase):
+    def setUp(self):
+        self.matches = coccigrep.CocciMatchSet(None)
+        for line in range(1, 6):
+            self.matches.add('a.c', line, 4, line, 8)
+
+    def lines(self, matches):
+        return [match.line for match in matches]
+
+    def test_index(self):
+        self.assertEqual(self.matches[0].line, 1)
+        self.assertEqual(self.matches[-1].line, 5)
+        self.assertRaises(IndexError, lambda: self.matches[5])
+        self.assertRaises(IndexError, lambda: self.matches[-6])
+
+    def test_slice(self):
+        self.assertEqual(self.lines(self.matches[:3]), [1, 2, 3])
+        self.assertEqual(self.lines(self.matches[-2:]), [4, 5])
+        self.assertEqual(self.lines(self.matches[::2]), [1, 3, 5])
+        self.assertEqual(self.lines(self.matches[::-1]), [5, 4, 3, 2, 1])
+        self.assertEqual(self.matches[10:], [])
+        match = self.matches[1:2][0]
+        self.assertEqual((match.file, match.column, match.columnend),
+                         ('a.c', 4, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()